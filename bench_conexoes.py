@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Teste de carga da tabela de conexões do Servidor: abre e fecha 100 mil
+conexões (metade com fechamento passivo, metade com fechamento ativo, que
+passa por TIME_WAIT) e em seguida simula um SYN flood, com os temporizadores
+padrão. A memória alocada é medida com tracemalloc a cada bloco de conexões e
+deve parar de crescer assim que o TIME_WAIT atingir o seu limite.
+
+Uso: python3 bench_conexoes.py [num_conexoes]
+"""
+import sys
+import asyncio
+import tracemalloc
+from tcp import Servidor
+from tcputils import *
+
+
+class RedeFalsa:
+    ignore_checksum = True
+
+    def __init__(self):
+        self.callback = None
+        self.ultimo = None
+
+    def registrar_recebedor(self, callback):
+        self.callback = callback
+
+    def enviar(self, segmento, dest_addr):
+        self.ultimo = segmento
+
+
+def dados_recebidos(conexao, dados):
+    if dados == b'':
+        conexao.fechar()
+
+
+def conexao_aceita(conexao):
+    conexao.registrar_recebedor(dados_recebidos)
+    if conexao.id_conexao[1] % 2:
+        conexao.fechar()   # fechamento ativo: o servidor manda o primeiro FIN
+
+
+async def main(n):
+    rede = RedeFalsa()
+    servidor = Servidor(rede, 7000)
+    servidor.registrar_monitor_de_conexoes_aceitas(conexao_aceita)
+
+    cliente, servidor_addr = '10.0.0.1', '10.0.0.2'
+
+    def segmento(porta, seq_no, ack_no, flags):
+        rede.callback(cliente, servidor_addr, make_header(porta, 7000, seq_no, ack_no, flags))
+        return read_header(rede.ultimo) if rede.ultimo else None
+
+    tracemalloc.start()
+    bloco = max(n // 10, 1)
+    base = None
+    for i in range(n):
+        porta = 1024 + i % 60000
+        _, _, seq_srv, _, _, _, _, _ = segmento(porta, 1000, 0, FLAGS_SYN)
+        rede.ultimo = None
+        segmento(porta, 1001, (seq_srv + 1) & 0xffffffff, FLAGS_ACK)
+        if porta % 2:
+            # servidor já mandou FIN; cliente confirma e fecha, levando a TIME_WAIT
+            segmento(porta, 1001, (seq_srv + 2) & 0xffffffff, FLAGS_FIN | FLAGS_ACK)
+        else:
+            # cliente fecha; aplicação responde com FIN e o cliente confirma
+            segmento(porta, 1001, (seq_srv + 1) & 0xffffffff, FLAGS_FIN | FLAGS_ACK)
+            segmento(porta, 1002, (seq_srv + 2) & 0xffffffff, FLAGS_ACK)
+        if i % 100 == 0:
+            # deixa o laço de eventos descartar os timers cancelados
+            await asyncio.sleep(0)
+        if (i + 1) % bloco == 0:
+            atual, pico = tracemalloc.get_traced_memory()
+            if base is None:
+                base = atual
+            print('%7d conexões: %8d bytes em uso (%+d), tabela=%d time_wait=%d' %
+                  (i + 1, atual, atual - base, len(servidor.conexoes), len(servidor.time_wait)))
+
+    # SYN flood: nenhum handshake é completado
+    for i in range(n):
+        rede.callback('10.1.%d.%d' % (i >> 8 & 0xff, i & 0xff), servidor_addr,
+                      make_header(1024 + i % 60000, 7000, i, 0, FLAGS_SYN))
+    atual, pico = tracemalloc.get_traced_memory()
+    print('SYN flood (%d SYNs): %d bytes em uso (%+d), semiabertas=%d' %
+          (n, atual, atual - base, len(servidor.semiabertas)))
+    tracemalloc.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
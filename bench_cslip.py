@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Compara SLIP e CSLIP num enlace simulado de 115200 baud (8N1, ou seja, 11520
+bytes/s). Para cada padrão de tráfego, passa os datagramas por um Enlace que
+transmite e outro que recebe, confere que os datagramas chegam idênticos e
+reporta os bytes de cabeçalho economizados e a taxa útil efetiva.
+
+Uso: python3 bench_cslip.py [num_pacotes]
+"""
+import sys
+import struct
+from slip import Enlace
+from tcputils import *
+from iputils import calc_checksum as ip_checksum
+
+BYTES_POR_SEGUNDO = 115200 // 10
+
+
+class Fio:
+    """ Liga diretamente duas pontas e conta os bytes que passam """
+    def __init__(self):
+        self.outra_ponta = None
+        self.callback = None
+        self.bytes = 0
+
+    def registrar_recebedor(self, callback):
+        self.callback = callback
+
+    def enviar(self, dados):
+        self.bytes += len(dados)
+        self.outra_ponta.callback(dados)
+
+
+class Fluxo:
+    """ Gera os datagramas de um sentido de uma conexão TCP """
+    def __init__(self, src_addr, dst_addr, src_port, dst_port):
+        self.src_addr, self.dst_addr = src_addr, dst_addr
+        self.src_port, self.dst_port = src_port, dst_port
+        self.seq_no, self.ack_no, self.ident = 0x12345678, 0x9abcdef0, 1000
+
+    def datagrama(self, dados=b'', ack=0, flags=FLAGS_ACK):
+        self.ack_no = (self.ack_no + ack) & 0xffffffff
+        segmento = fix_checksum(make_header(self.src_port, self.dst_port, self.seq_no,
+                                            self.ack_no, flags) + dados,
+                                self.src_addr, self.dst_addr)
+        self.seq_no = (self.seq_no + len(dados)) & 0xffffffff
+        self.ident = (self.ident + 1) & 0xffff
+        cabecalho = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(segmento), self.ident,
+                                0x4000, 64, 6, 0, str2addr(self.src_addr), str2addr(self.dst_addr))
+        cabecalho = cabecalho[:10] + struct.pack('!H', ip_checksum(cabecalho)) + cabecalho[12:]
+        return cabecalho + segmento
+
+
+def interativo(n):
+    # Eco de teclas: cada lado envia 1 byte e confirma o byte do outro
+    cliente = Fluxo('192.168.200.1', '192.168.200.4', 40000, 7000)
+    servidor = Fluxo('192.168.200.4', '192.168.200.1', 7000, 40000)
+    for i in range(n // 2):
+        yield 0, cliente.datagrama(b'k', ack=1 if i else 0, flags=FLAGS_ACK | 0x08), 1
+        yield 1, servidor.datagrama(b'k', ack=1, flags=FLAGS_ACK | 0x08), 1
+
+
+def bulk(n):
+    # Transferência num sentido, com um ACK a cada dois segmentos de 256 bytes
+    origem = Fluxo('192.168.200.1', '192.168.200.4', 40001, 7000)
+    destino = Fluxo('192.168.200.4', '192.168.200.1', 7000, 40001)
+    dados = bytes(range(256))
+    for i in range(n):
+        if i % 3 == 2:
+            yield 1, destino.datagrama(ack=512), 0
+        else:
+            yield 0, origem.datagrama(dados), len(dados)
+
+
+def medir(padrao, n, cslip):
+    # Cada ponta transmite pelo seu fio, que entrega os bytes na ponta oposta
+    ida, volta = Fio(), Fio()
+    a, b = Enlace(ida, cslip), Enlace(volta, cslip)
+    ida.outra_ponta, volta.outra_ponta = volta, ida
+    recebidos = {0: [], 1: []}
+    b.registrar_recebedor(lambda d: recebidos[0].append(bytes(d)))
+    a.registrar_recebedor(lambda d: recebidos[1].append(bytes(d)))
+
+    enviados = {0: [], 1: []}
+    util = 0
+    for sentido, datagrama, tamanho in padrao(n):
+        (a if sentido == 0 else b).enviar(datagrama)
+        enviados[sentido].append(datagrama)
+        util += tamanho
+    assert enviados == recebidos, 'datagrama corrompido pela compressão'
+    total = ida.bytes + volta.bytes
+    economia = a.compressor.bytes_economizados + b.compressor.bytes_economizados
+    return total, economia, util
+
+
+def main(n):
+    for padrao in (interativo, bulk):
+        total_slip, _, util = medir(padrao, n, False)
+        total_cslip, economia, _ = medir(padrao, n, True)
+        print('%s (%d pacotes):' % (padrao.__name__, n))
+        for nome, total in (('SLIP', total_slip), ('CSLIP', total_cslip)):
+            print('  %-5s %8d bytes no fio, %6.1f s, goodput %7.1f B/s' %
+                  (nome, total, total / BYTES_POR_SEGUNDO, util * BYTES_POR_SEGUNDO / total))
+        print('  cabeçalhos: %d bytes economizados (%.1f por pacote)' % (economia, economia / n))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3000)
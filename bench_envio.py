@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Envia um arquivo grande (1 GiB por padrão) com Conexao.enviar_arquivo por um
+enlace de loopback em memória, no qual a outra ponta apenas confirma os
+segmentos recebidos. Reporta a taxa útil (goodput) e o pico de memória
+residente (RSS) do processo.
+
+Uso: python3 bench_envio.py [tamanho_em_MiB] [--arquivo]
+
+Por padrão o arquivo é passado como caminho (mmap); com --arquivo ele é
+passado como objeto arquivo aberto.
+"""
+import os
+import sys
+import time
+import asyncio
+import resource
+import tempfile
+from tcp import Servidor
+from tcputils import *
+
+
+CLIENTE, SERVIDOR = '10.0.0.1', '10.0.0.2'
+
+
+class Loopback:
+    """
+    Camada de rede de mentira: entrega os segmentos do servidor a um receptor
+    que confirma tudo o que chegar em ordem, sempre através do laço de eventos.
+    """
+    ignore_checksum = True
+
+    def __init__(self):
+        self.callback = None
+        self.esperado = None
+        self.recebidos = 0
+        self.loop = asyncio.get_event_loop()
+
+    def registrar_recebedor(self, callback):
+        self.callback = callback
+
+    def enviar(self, segmento, dest_addr):
+        self.loop.call_soon(self._receber, segmento)
+
+    def _receber(self, segmento):
+        src_port, dst_port, seq_no, ack_no, flags, _, _, _ = read_header(segmento)
+        tamanho = len(segmento) - 20
+        if flags & FLAGS_SYN:
+            self.esperado = (seq_no + 1) & 0xffffffff
+            self._segmento(1001, self.esperado, FLAGS_ACK)
+            return
+        if seq_no == self.esperado and tamanho:
+            self.esperado = (self.esperado + tamanho) & 0xffffffff
+            self.recebidos += tamanho
+            self._segmento(1001, self.esperado, FLAGS_ACK)
+
+    def _segmento(self, seq_no, ack_no, flags):
+        self.callback(CLIENTE, SERVIDOR, make_header(1234, 7000, seq_no, ack_no, flags))
+
+
+def rss_maximo():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def main(mib, como_objeto):
+    tamanho = mib << 20
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.truncate(tamanho)
+        caminho = f.name
+    try:
+        rede = Loopback()
+        servidor = Servidor(rede, 7000)
+        conexoes = []
+        servidor.registrar_monitor_de_conexoes_aceitas(conexoes.append)
+        rede._segmento(1000, 0, FLAGS_SYN)
+        await asyncio.sleep(0.01)
+        conexao, = conexoes
+
+        print('RSS antes do envio: %.1f MiB' % rss_maximo())
+        inicio = time.perf_counter()
+        if como_objeto:
+            with open(caminho, 'rb') as arquivo:
+                total = await conexao.enviar_arquivo(arquivo)
+        else:
+            total = await conexao.enviar_arquivo(caminho)
+        duracao = time.perf_counter() - inicio
+
+        assert total == tamanho == rede.recebidos
+        print('%d MiB em %.1f s: goodput %.1f Mbit/s, cwnd final %d segmentos' %
+              (mib, duracao, 8 * tamanho / duracao / 1e6, conexao.cwnd // MSS))
+        print('RSS máximo: %.1f MiB' % rss_maximo())
+    finally:
+        os.unlink(caminho)
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    asyncio.run(main(int(args[0]) if args else 1024, '--arquivo' in sys.argv))
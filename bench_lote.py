@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Compara a entrega item a item com a entrega em lote (registrar_recebedor_lote)
+passando pela pilha completa (SLIP -> IP -> TCP) em dois cenários:
+
+ * dados: o cliente envia segmentos pequenos, que o servidor precisa confirmar;
+ * acks: o servidor envia um arquivo e o cliente confirma cada segmento.
+
+Em cada despertar do laço de eventos a linha serial entrega todos os quadros
+acumulados. Reporta o custo de CPU por pacote e quantos segmentos o servidor
+precisou transmitir.
+
+Uso: python3 bench_lote.py [num_pacotes]
+"""
+import sys
+import time
+import struct
+import asyncio
+from ip import IP
+from slip import CamadaEnlace
+from tcp import Servidor
+from tcputils import *
+from bench_recepcao import CLIENTE, SERVIDOR, tcp
+
+LOTE = 32
+
+
+class LinhaFalsa:
+    def __init__(self):
+        self.callback = None
+        self.callback_lote = None
+        self.enviados = []
+
+    def registrar_recebedor(self, callback):
+        self.callback = callback
+
+    def registrar_recebedor_lote(self, callback):
+        self.callback_lote = callback
+
+    def enviar(self, dados):
+        self.enviados.append(dados)
+
+    def entregar(self, quadros):
+        if self.callback_lote:
+            self.callback_lote(quadros)
+        else:
+            for quadro in quadros:
+                self.callback(quadro)
+
+
+def segmentos_enviados(linha):
+    """ Decodifica os quadros SLIP transmitidos pelo servidor """
+    for dados in linha.enviados:
+        datagrama = dados.strip(b'\xC0').replace(b'\xDB\xDC', b'\xC0').replace(b'\xDB\xDD', b'\xDB')
+        seq_no, = struct.unpack_from('!I', datagrama, 24)
+        yield seq_no, len(datagrama) - 40
+    linha.enviados.clear()
+
+
+async def preparar(lote):
+    linha = LinhaFalsa()
+    rede = IP(CamadaEnlace({CLIENTE: linha}))
+    rede.definir_endereco_host(SERVIDOR)
+    rede.definir_tabela_encaminhamento([('0.0.0.0/0', CLIENTE)])
+    servidor = Servidor(rede, 7000, lote=lote)
+    conexoes = []
+    servidor.registrar_monitor_de_conexoes_aceitas(conexoes.append)
+    linha.entregar([tcp(1000, 0, FLAGS_SYN)])
+    await asyncio.sleep(0)
+    seq_srv, = [seq_no for seq_no, _ in segmentos_enviados(linha)]
+    ack = (seq_srv + 1) & 0xffffffff
+    linha.entregar([tcp(1001, ack, FLAGS_ACK)])
+    await asyncio.sleep(0)
+    conexao, = conexoes
+    conexao.registrar_recebedor(lambda c, dados: None)
+    linha.enviados.clear()
+    return linha, conexao, ack
+
+
+async def dados(n, lote):
+    linha, conexao, ack = await preparar(lote)
+    quadros = [tcp(1001 + 64*i, ack, FLAGS_ACK, b'd' * 64) for i in range(n)]
+    inicio = time.process_time()
+    for i in range(0, n, LOTE):
+        linha.entregar(quadros[i:i+LOTE])
+        await asyncio.sleep(0)
+    return time.process_time() - inicio, len(linha.enviados)
+
+
+async def acks(n, lote):
+    linha, conexao, ack = await preparar(lote)
+    futuro = conexao.enviar_stream(blocos(n * MSS))
+    await asyncio.sleep(0)
+    inicio = time.process_time()
+    transmitidos = confirmados = 0
+    while not futuro.done():
+        quadros = []
+        for seq_no, tamanho in segmentos_enviados(linha):
+            transmitidos += 1
+            quadros.append(tcp(1001, (seq_no + tamanho) & 0xffffffff, FLAGS_ACK))
+        confirmados += len(quadros)
+        for i in range(0, len(quadros), LOTE):
+            linha.entregar(quadros[i:i+LOTE])
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+    return time.process_time() - inicio, transmitidos
+
+
+async def blocos(total):
+    bloco = b'x' * (16 * MSS)
+    for _ in range(0, total, len(bloco)):
+        yield bloco
+
+
+async def main(n):
+    for cenario in (dados, acks):
+        for lote in (False, True):
+            duracao, transmitidos = await cenario(n, lote)
+            print('%-5s %-10s %6.1f µs/pacote, %6d segmentos transmitidos pelo servidor' %
+                  (cenario.__name__, 'lote' if lote else 'item', 1e6 * duracao / n, transmitidos))
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Mede com tracemalloc quantos bytes cada Conexao ocupa, tanto ociosa (logo
+após o handshake) quanto ativa (com dados em voo aguardando confirmação e
+timer de retransmissão agendado).
+
+Uso: python3 bench_memoria.py [n1 n2 ...]
+"""
+import gc
+import sys
+import asyncio
+import tracemalloc
+from tcp import Servidor
+from tcputils import *
+from bench_conexoes import RedeFalsa
+
+TAMANHO_DADOS = 512
+
+
+def medir():
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+async def main(quantidades):
+    print('%8s %14s %14s' % ('conexões', 'B/ociosa', 'B/ativa'))
+    for n in quantidades:
+        rede = RedeFalsa()
+        servidor = Servidor(rede, 7000)
+        servidor.max_conexoes = servidor.max_semiabertas = 2*n
+        # Endereços e dados criados antes da medição, como viriam da camada de rede
+        clientes = ['10.%d.%d.%d' % (i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff) for i in range(n)]
+        dados = b'x' * TAMANHO_DADOS
+
+        tracemalloc.start()
+        antes = medir()
+        for cliente in clientes:
+            rede.callback(cliente, '10.255.0.1', make_header(1234, 7000, 1000, 0, FLAGS_SYN))
+            _, _, seq_srv, _, _, _, _, _ = read_header(rede.ultimo)
+            rede.callback(cliente, '10.255.0.1',
+                          make_header(1234, 7000, 1001, (seq_srv + 1) & 0xffffffff, FLAGS_ACK))
+        ociosas = medir()
+        for conexao in servidor.conexoes.values():
+            conexao.enviar(dados)
+        ativas = medir()
+        tracemalloc.stop()
+
+        print('%8d %14.1f %14.1f' % (n, (ociosas - antes) / n, (ativas - antes) / n))
+        for conexao in list(servidor.conexoes.values()):
+            servidor._remover(conexao)
+        if servidor.timer is not None:
+            servidor.timer.cancel()
+        await asyncio.sleep(0)
+
+
+if __name__ == '__main__':
+    asyncio.run(main([int(x) for x in sys.argv[1:]] or [1000, 10000, 50000]))
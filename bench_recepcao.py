@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Mede o custo de receber um segmento TCP de 1460 bytes pela pilha completa
+(SLIP -> IP -> TCP -> aplicação): tempo por segmento e pico de memória
+transitória alocada durante a recepção. O pico inclui a única cópia do
+payload que resta no caminho, o bytes entregue à aplicação (cerca de 1,5 KB),
+mais os objetos de tamanho fixo criados por segmento (strings de endereço,
+tuplas de cabeçalho, inteiros do checksum), que somam outro tanto.
+
+Uso: python3 bench_recepcao.py [num_segmentos]
+"""
+import sys
+import time
+import struct
+import asyncio
+import tracemalloc
+from ip import IP
+from slip import CamadaEnlace
+from tcp import Servidor
+from tcputils import *
+from iputils import calc_checksum as ip_checksum
+
+
+class LinhaFalsa:
+    def __init__(self):
+        self.callback = None
+
+    def registrar_recebedor(self, callback):
+        self.callback = callback
+
+    def enviar(self, dados):
+        pass
+
+
+CLIENTE, SERVIDOR = '10.0.0.1', '10.0.0.2'
+
+
+def quadro(segmento):
+    cabecalho = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(segmento), 0, 0, 64, 6, 0,
+                            str2addr(CLIENTE), str2addr(SERVIDOR))
+    cabecalho = cabecalho[:10] + struct.pack('!H', ip_checksum(cabecalho)) + cabecalho[12:]
+    datagrama = cabecalho + segmento
+    return b'\xC0' + datagrama.replace(b'\xDB', b'\xDB\xDD').replace(b'\xC0', b'\xDB\xDC') + b'\xC0'
+
+
+def tcp(seq_no, ack_no, flags, payload=b''):
+    return quadro(fix_checksum(make_header(1234, 7000, seq_no, ack_no, flags) + payload,
+                               CLIENTE, SERVIDOR))
+
+
+async def main(n):
+    linha = LinhaFalsa()
+    rede = IP(CamadaEnlace({CLIENTE: linha}))
+    rede.definir_endereco_host(SERVIDOR)
+    rede.definir_tabela_encaminhamento([('0.0.0.0/0', CLIENTE)])
+    servidor = Servidor(rede, 7000)
+    recebidos = []
+    servidor.registrar_monitor_de_conexoes_aceitas(
+        lambda conexao: conexao.registrar_recebedor(lambda c, dados: recebidos.append(len(dados))))
+
+    linha.callback(tcp(1000, 0, FLAGS_SYN))
+    seq_srv = next(iter(servidor.semiabertas.values()))[0]
+    ack = (seq_srv + 1) & 0xffffffff
+    linha.callback(tcp(1001, ack, FLAGS_ACK))
+
+    payload = b'a' * MSS
+    quadros = [tcp(1001 + i*MSS, ack, FLAGS_ACK, payload) for i in range(n)]
+
+    tracemalloc.start()
+    picos = []
+    for q in quadros[:min(n, 1000)]:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        linha.callback(q)
+        picos.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+
+    inicio = time.perf_counter()
+    for q in quadros[len(picos):]:
+        linha.callback(q)
+    duracao = time.perf_counter() - inicio
+
+    assert len(recebidos) == n and set(recebidos) == {MSS}
+    picos.sort()
+    print('pico de memória transitória por segmento: mediana %d bytes, máx %d bytes' %
+          (picos[len(picos)//2], picos[-1]))
+    if n > len(picos):
+        print('tempo por segmento: %.1f µs' % (1e6 * duracao / (n - len(picos))))
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Mede a taxa de encaminhamento do roteador com 1, 2, ... processos
+trabalhadores. Cada porta do roteador é uma LinhaVirtual ligada a um host
+simulado; o host da porta i envia continuamente datagramas para o host da
+porta i+1, de forma que todos os datagramas cruzam portas e, com mais de um
+trabalhador, parte deles passa pelos anéis em memória compartilhada.
+
+Os hosts simulados rodam neste processo e só escrevem quadros prontos e
+contam os quadros que chegam, então o gargalo é o roteador. Para que os
+números façam sentido é preciso ter pelo menos um núcleo livre por
+trabalhador, além de um para este processo.
+
+Uso: python3 bench_roteador.py [max_trabalhadores] [segundos]
+"""
+import os
+import sys
+import time
+import struct
+import selectors
+from camadafisica import LinhaVirtual
+from roteador import RoteadorMultiprocesso
+from iputils import str2addr, calc_checksum
+
+PORTAS = 8
+ROTEADOR = '10.0.255.254'
+QUADROS_POR_ESCRITA = 64
+
+
+def host(i):
+    return '10.0.%d.1' % i
+
+
+def quadro(origem, destino, ident):
+    cabecalho = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + 64, ident, 0, 64, 17, 0,
+                            str2addr(origem), str2addr(destino))
+    cabecalho = cabecalho[:10] + struct.pack('!H', calc_checksum(cabecalho)) + cabecalho[12:]
+    datagrama = cabecalho + b'u' * 64
+    return b'\xC0' + datagrama.replace(b'\xDB', b'\xDB\xDD').replace(b'\xC0', b'\xDB\xDC') + b'\xC0'
+
+
+def medir(trabalhadores, segundos):
+    linhas, pontas = {}, []
+    for i in range(PORTAS):
+        do_roteador, do_host = LinhaVirtual.par()
+        linhas[host(i)] = do_roteador
+        pontas.append(do_host.sock)
+    tabela = [('10.0.%d.0/24' % i, host(i)) for i in range(PORTAS)]
+    roteador = RoteadorMultiprocesso(linhas, ROTEADOR, tabela, trabalhadores)
+    roteador.iniciar()
+    for linha in linhas.values():
+        linha.sock.close()   # agora pertencem aos trabalhadores
+
+    rajadas = [b''.join(quadro(host(i), host((i + 1) % PORTAS), n)
+                        for n in range(QUADROS_POR_ESCRITA)) for i in range(PORTAS)]
+    seletor = selectors.DefaultSelector()
+    for i, sock in enumerate(pontas):
+        seletor.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, i)
+
+    delimitadores = 0
+    medindo = False
+    inicio = time.monotonic()
+    while True:
+        agora = time.monotonic()
+        if not medindo and agora - inicio > 0.5:
+            # Descarta o aquecimento
+            medindo, delimitadores, inicio = True, 0, agora
+        elif medindo and agora - inicio > segundos:
+            break
+        for chave, eventos in seletor.select(0.1):
+            sock = chave.fileobj
+            if eventos & selectors.EVENT_READ:
+                try:
+                    delimitadores += sock.recv(65536).count(b'\xC0')
+                except BlockingIOError:
+                    pass
+            if eventos & selectors.EVENT_WRITE:
+                try:
+                    sock.send(rajadas[chave.data])
+                except BlockingIOError:
+                    pass
+    duracao = time.monotonic() - inicio
+
+    roteador.parar()
+    for sock in pontas:
+        sock.close()
+    return delimitadores / 2 / duracao
+
+
+def main(maximo, segundos):
+    print('%d núcleo(s) disponível(is)' % len(os.sched_getaffinity(0)))
+    base = None
+    n = 1
+    while n <= maximo:
+        pps = medir(n, segundos)
+        base = base or pps
+        print('%2d trabalhador(es): %8.0f datagramas/s encaminhados (%.2fx)' % (n, pps, pps / base))
+        n *= 2
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 4,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 3)
@@ -4,11 +4,15 @@ import errno
 import fcntl
 import struct
 import termios
+import socket
 import asyncio
 import traceback
 from collections import defaultdict
 
 
+MAX_LEITURAS = 16   # leituras por despertar da PTY ao entregar em lote
+
+
 class ZyboSerialDriver:
     """ Driver para o hardware de https://github.com/thotypous/zybo-z7-20-uart """
 
@@ -19,6 +23,7 @@ class ZyboSerialDriver:
         asyncio.get_event_loop().add_reader(self.fd, self.__irq_handler)
         self.__irq_unmask()
         self.callbacks = defaultdict(lambda: lambda _: None)
+        self.callbacks_lote = {}
 
     def obter_porta(self, port):
         """ Obtém uma porta para controlar a partir do software em Python """
@@ -39,6 +44,9 @@ class ZyboSerialDriver:
     def registrar_recebedor(self, port, callback):
         self.callbacks[port] = callback
 
+    def registrar_recebedor_lote(self, port, callback):
+        self.callbacks_lote[port] = callback
+
     def __irq_handler(self):
         os.read(self.fd, 4)   # diz ao SO que coletamos a irq
         buffers = defaultdict(lambda: bytearray())
@@ -47,10 +55,15 @@ class ZyboSerialDriver:
             if elem == -1: break                      # fila vazia
             port, b = elem>>8, elem&0xff
             buffers[port].append(b)
+        callbacks, callbacks_lote = self.callbacks, self.callbacks_lote
         for port, dados in buffers.items():
             try:
                 #print('recv', port, dados)
-                self.callbacks[port](bytes(dados))
+                if port in callbacks_lote:
+                    # Tudo o que a porta recebeu já foi coletado nesta interrupção
+                    callbacks_lote[port]([dados])
+                else:
+                    callbacks[port](dados)
             except:
                 traceback.print_exc()
         self.__irq_unmask()
@@ -68,6 +81,12 @@ class ZyboSerialPort:
         Registra uma função para ser chamada quando vierem dados da linha serial
         """
         self.driver.registrar_recebedor(self.port, callback)
+    def registrar_recebedor_lote(self, callback):
+        """
+        Registra uma função para ser chamada com a lista de blocos de dados
+        recebidos da linha serial a cada interrupção
+        """
+        self.driver.registrar_recebedor_lote(self.port, callback)
     def enviar(self, dados):
         """
         Envia dados para a linha serial
@@ -97,9 +116,14 @@ class PTY:
         os.close(slave_fd)
         self.pty = pty
         self.pty_name = pty_name
+        self.callback = None
+        self.callback_lote = None
         asyncio.get_event_loop().add_reader(pty, self.__raw_recv)
 
     def __raw_recv(self):
+        if self.callback_lote:
+            self.__raw_recv_lote()
+            return
         try:
             dados = os.read(self.pty, 2048)
             if self.callback:
@@ -110,15 +134,129 @@ class PTY:
             else:
                 raise e
 
+    def __raw_recv_lote(self):
+        # Esvazia o que já estiver disponível, até MAX_LEITURAS leituras
+        lista = []
+        try:
+            for _ in range(MAX_LEITURAS):
+                lista.append(os.read(self.pty, 2048))
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            if e.errno != errno.EIO:
+                raise e
+        if lista:
+            self.callback_lote(lista)
+
     def registrar_recebedor(self, callback):
         """
         Registra uma função para ser chamada quando vierem dados da linha serial
         """
         self.callback = callback
 
+    def registrar_recebedor_lote(self, callback):
+        """
+        Registra uma função para ser chamada com a lista de blocos de dados
+        lidos da linha serial a cada vez que ela ficar pronta para leitura
+        """
+        self.callback_lote = callback
+
     def enviar(self, dados):
         """
         Envia dados para a linha serial
         """
         os.write(self.pty, dados)
 
+
+
+class LinhaVirtual:
+    """
+    Linha serial virtual baseada em um par de sockets, com a mesma interface
+    da PTY. Útil para simulações e para ligar processos diferentes da mesma
+    máquina: o leitor só é registrado no laço de eventos quando alguém se
+    registra para receber, então as pontas podem ser criadas antes de um fork.
+    """
+
+    def __init__(self, sock):
+        sock.setblocking(False)
+        self.sock = sock
+        self.callback = None
+        self.callback_lote = None
+        self.registrado = False
+        self.pendente = None   # restante de um quadro que não coube de uma vez no socket
+        self.descartados = 0   # quadros perdidos por falta de espaço no buffer
+
+    @staticmethod
+    def par():
+        """ Cria as duas pontas de uma linha serial virtual """
+        a, b = socket.socketpair()
+        return LinhaVirtual(a), LinhaVirtual(b)
+
+    def __registrar_leitor(self):
+        if not self.registrado:
+            asyncio.get_event_loop().add_reader(self.sock.fileno(), self.__raw_recv)
+            self.registrado = True
+
+    def __raw_recv(self):
+        lista = []
+        try:
+            for _ in range(MAX_LEITURAS if self.callback_lote else 1):
+                dados = self.sock.recv(65536)
+                if not dados:
+                    # a outra ponta está fechada
+                    asyncio.get_event_loop().remove_reader(self.sock.fileno())
+                    self.registrado = False
+                    break
+                lista.append(dados)
+        except BlockingIOError:
+            pass
+        if not lista:
+            return
+        if self.callback_lote:
+            self.callback_lote(lista)
+        elif self.callback:
+            self.callback(lista[0])
+
+    def registrar_recebedor(self, callback):
+        """
+        Registra uma função para ser chamada quando vierem dados da linha serial
+        """
+        self.callback = callback
+        self.__registrar_leitor()
+
+    def registrar_recebedor_lote(self, callback):
+        """
+        Registra uma função para ser chamada com a lista de blocos de dados
+        lidos da linha serial a cada vez que ela ficar pronta para leitura
+        """
+        self.callback_lote = callback
+        self.__registrar_leitor()
+
+    def __escrever(self):
+        try:
+            n = self.sock.send(self.pendente)
+        except BlockingIOError:
+            return
+        self.pendente = self.pendente[n:]
+        if not self.pendente:
+            self.pendente = None
+            asyncio.get_event_loop().remove_writer(self.sock.fileno())
+
+    def enviar(self, dados):
+        """
+        Envia dados para a linha serial. Cada chamada é tratada como uma
+        unidade (a camada de enlace envia um quadro SLIP por chamada): se o
+        buffer estiver cheio o quadro inteiro é perdido, mas um quadro que
+        começou a ser transmitido nunca é cortado ao meio.
+        """
+        if self.pendente is not None:
+            self.descartados += 1   # ainda terminando o quadro anterior
+            return
+        try:
+            n = self.sock.send(dados)
+        except BlockingIOError:
+            self.descartados += 1
+            return
+        if n < len(dados):
+            self.pendente = memoryview(dados)[n:]
+            asyncio.get_event_loop().add_writer(self.sock.fileno(), self.__escrever)
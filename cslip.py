@@ -0,0 +1,286 @@
+"""
+Compressão de cabeçalhos TCP/IP de Van Jacobson (CSLIP, RFC 1144), compatível
+com a implementação do Linux (slattach -p cslip).
+
+Cada ponta de um enlace guarda uma cópia do último cabeçalho IP+TCP enviado
+(ou recebido) em cada conexão, identificada por um número de slot. Os
+pacotes comprimidos levam apenas as diferenças em relação a essa cópia.
+O tipo do pacote é codificado nos bits mais altos do primeiro byte.
+"""
+import struct
+from collections import OrderedDict
+from iputils import calc_checksum
+
+TYPE_IP = 0x40
+TYPE_UNCOMPRESSED_TCP = 0x70
+TYPE_COMPRESSED_TCP = 0x80
+
+# Bits do byte de mudanças de um pacote comprimido
+NEW_C = 0x40   # número do slot presente
+NEW_I = 0x20   # identificação IP mudou de algo diferente de 1
+NEW_P = 0x10   # flag PSH
+NEW_S = 0x08   # número de sequência
+NEW_A = 0x04   # número de confirmação
+NEW_W = 0x02   # janela
+NEW_U = 0x01   # ponteiro de urgência
+
+# Combinações impossíveis de S, A, W e U usadas como casos especiais
+SPECIAL_I = NEW_S | NEW_W | NEW_U            # tráfego interativo ecoado
+SPECIAL_D = NEW_S | NEW_A | NEW_W | NEW_U    # tráfego de dados unidirecional
+SPECIALS_MASK = NEW_S | NEW_A | NEW_W | NEW_U
+
+TH_FIN = 0x01
+TH_SYN = 0x02
+TH_RST = 0x04
+TH_PUSH = 0x08
+TH_ACK = 0x10
+TH_URG = 0x20
+
+MAX_SLOTS = 16
+
+
+def _codificar(saida, n):
+    # Valores de 1 a 255 ocupam um byte; os demais, um zero seguido de 16 bits
+    if 0 < n < 256:
+        saida.append(n)
+    else:
+        saida += struct.pack('!BH', 0, n)
+
+
+def _decodificar(quadro, i):
+    if quadro[i] == 0:
+        return (quadro[i+1] << 8) | quadro[i+2], i + 3
+    return quadro[i], i + 1
+
+
+class CompressorVJ:
+    def __init__(self, slots=MAX_SLOTS):
+        """
+        Mantém o estado de compressão de um enlace: até `slots` conexões em
+        cada sentido. Os dois lados do enlace precisam usar o mesmo número.
+        """
+        self.slots = slots
+        self.tx = OrderedDict()   # quádrupla -> [slot, cabeçalho], da menos para a mais recente
+        self.tx_ultimo = None
+        self.rx = [None] * slots
+        self.rx_ultimo = None
+        self.descartar = False
+        self.bytes_economizados = 0
+
+    def comprimir(self, datagrama):
+        """
+        Recebe um datagrama IPv4 e devolve o pacote a ser enquadrado pelo SLIP,
+        que pode ser o próprio datagrama (TYPE_IP), o datagrama com o número do
+        slot no lugar do protocolo (TYPE_UNCOMPRESSED_TCP) ou um cabeçalho
+        comprimido seguido dos dados (TYPE_COMPRESSED_TCP).
+        """
+        d = datagrama
+        if len(d) < 40 or (d[0] >> 4) != 4 or d[9] != 6:
+            return d
+        ihl = (d[0] & 0xf) * 4
+        flagsfrag, = struct.unpack_from('!H', d, 6)
+        if flagsfrag & 0x3fff or len(d) < ihl + 20:
+            return d    # fragmentos não são comprimidos
+        hlen = ihl + (d[ihl+12] >> 4) * 4
+        flags = d[ihl+13]
+        if len(d) < hlen or (flags & (TH_SYN | TH_FIN | TH_RST | TH_ACK)) != TH_ACK:
+            return d
+
+        chave = bytes(d[12:20]) + bytes(d[ihl:ihl+4])
+        slot = self.tx.get(chave)
+        if slot is None:
+            if len(self.tx) < self.slots:
+                cid = len(self.tx)
+            else:
+                _, (cid, _) = self.tx.popitem(last=False)
+            self.tx[chave] = [cid, bytes(d[:hlen])]
+            return self._nao_comprimido(d, cid)
+        self.tx.move_to_end(chave)
+        cid, antigo = slot
+        slot[1] = bytes(d[:hlen])
+
+        if len(antigo) != hlen or antigo[0:2] != d[0:2] or antigo[6:10] != d[6:10] or \
+                antigo[20:ihl] != d[20:ihl] or antigo[ihl+12] != d[ihl+12] or \
+                antigo[ihl+20:hlen] != d[ihl+20:hlen]:
+            return self._nao_comprimido(d, cid)
+
+        comprimento, ident = struct.unpack_from('!HH', d, 2)
+        comprimento_ant, ident_ant = struct.unpack_from('!HH', antigo, 2)
+        seq, ack, _, win, checksum, urp = struct.unpack_from('!IIHHHH', d, ihl+4)
+        seq_ant, ack_ant, _, win_ant, _, urp_ant = struct.unpack_from('!IIHHHH', antigo, ihl+4)
+
+        deltas = bytearray()
+        changes = 0
+        if flags & TH_URG:
+            _codificar(deltas, urp)
+            changes |= NEW_U
+        elif urp != urp_ant:
+            return self._nao_comprimido(d, cid)
+        delta_w = (win - win_ant) & 0xffff
+        if delta_w:
+            _codificar(deltas, delta_w)
+            changes |= NEW_W
+        delta_a = (ack - ack_ant) & 0xffffffff
+        if delta_a:
+            if delta_a > 0xffff:
+                return self._nao_comprimido(d, cid)
+            _codificar(deltas, delta_a)
+            changes |= NEW_A
+        delta_s = (seq - seq_ant) & 0xffffffff
+        if delta_s:
+            if delta_s > 0xffff:
+                return self._nao_comprimido(d, cid)
+            _codificar(deltas, delta_s)
+            changes |= NEW_S
+
+        dados_ant = comprimento_ant - hlen
+        if changes == 0:
+            # Nada mudou: só comprimimos se for um pacote de dados vindo logo
+            # após um ACK puro; do contrário é provavelmente uma retransmissão
+            if comprimento == comprimento_ant or comprimento_ant != hlen:
+                return self._nao_comprimido(d, cid)
+        elif changes in (SPECIAL_I, SPECIAL_D):
+            return self._nao_comprimido(d, cid)
+        elif changes == NEW_S | NEW_A:
+            if delta_s == delta_a and delta_s == dados_ant:
+                changes = SPECIAL_I
+                deltas.clear()
+        elif changes == NEW_S:
+            if delta_s == dados_ant:
+                changes = SPECIAL_D
+                deltas.clear()
+
+        delta_i = (ident - ident_ant) & 0xffff
+        if delta_i != 1:
+            _codificar(deltas, delta_i)
+            changes |= NEW_I
+        if flags & TH_PUSH:
+            changes |= NEW_P
+
+        if cid != self.tx_ultimo:
+            self.tx_ultimo = cid
+            pacote = bytearray((TYPE_COMPRESSED_TCP | NEW_C | changes, cid))
+        else:
+            pacote = bytearray((TYPE_COMPRESSED_TCP | changes,))
+        pacote += struct.pack('!H', checksum)
+        pacote += deltas
+        self.bytes_economizados += hlen - len(pacote)
+        pacote += d[hlen:comprimento]
+        return bytes(pacote)
+
+    def _nao_comprimido(self, d, cid):
+        self.tx_ultimo = cid
+        pacote = bytearray(d)
+        pacote[0] |= TYPE_UNCOMPRESSED_TCP
+        pacote[9] = cid
+        return bytes(pacote)
+
+    def descomprimir(self, quadro):
+        """
+        Reconstrói o datagrama IPv4 a partir de um quadro recebido. Devolve
+        None se o quadro precisar ser descartado.
+        """
+        if not quadro:
+            return None
+        tipo = quadro[0]
+        if tipo & TYPE_COMPRESSED_TCP:
+            try:
+                return self._descomprimir_tcp(quadro)
+            except (IndexError, struct.error):
+                self.erro()
+                return None
+        if tipo >= TYPE_UNCOMPRESSED_TCP:
+            d = bytearray(quadro)
+            if len(d) < 40:
+                self.erro()
+                return None
+            d[0] &= 0x4f
+            ihl = (d[0] & 0xf) * 4
+            cid = d[9]
+            hlen = ihl + (d[ihl+12] >> 4) * 4
+            if cid >= self.slots or len(d) < hlen:
+                self.erro()
+                return None
+            d[9] = 6
+            self.rx[cid] = bytes(d[:hlen])
+            self.rx_ultimo = cid
+            self.descartar = False
+            return d
+        return quadro
+
+    def _descomprimir_tcp(self, quadro):
+        changes = quadro[0]
+        i = 1
+        if changes & NEW_C:
+            cid = quadro[1]
+            i = 2
+            if cid >= self.slots or self.rx[cid] is None:
+                self.erro()
+                return None
+            self.descartar = False
+            self.rx_ultimo = cid
+        elif self.descartar or self.rx_ultimo is None:
+            return None
+        else:
+            cid = self.rx_ultimo
+
+        cab = bytearray(self.rx[cid])
+        hlen = len(cab)
+        ihl = (cab[0] & 0xf) * 4
+        cab[ihl+16:ihl+18] = quadro[i:i+2]
+        i += 2
+        if changes & NEW_P:
+            cab[ihl+13] |= TH_PUSH
+        else:
+            cab[ihl+13] &= ~TH_PUSH & 0xff
+
+        comprimento_ant, ident = struct.unpack_from('!HH', cab, 2)
+        seq, ack, _, win, _, urp = struct.unpack_from('!IIHHHH', cab, ihl+4)
+        especial = changes & SPECIALS_MASK
+        if especial == SPECIAL_I:
+            n = comprimento_ant - hlen
+            ack += n
+            seq += n
+        elif especial == SPECIAL_D:
+            seq += comprimento_ant - hlen
+        else:
+            if changes & NEW_U:
+                cab[ihl+13] |= TH_URG
+                urp, i = _decodificar(quadro, i)
+            else:
+                cab[ihl+13] &= ~TH_URG & 0xff
+            if changes & NEW_W:
+                delta, i = _decodificar(quadro, i)
+                win += delta
+            if changes & NEW_A:
+                delta, i = _decodificar(quadro, i)
+                ack += delta
+            if changes & NEW_S:
+                delta, i = _decodificar(quadro, i)
+                seq += delta
+        if changes & NEW_I:
+            delta, i = _decodificar(quadro, i)
+            ident += delta
+        else:
+            ident += 1
+        if i > len(quadro):
+            raise IndexError('pacote comprimido truncado')
+
+        struct.pack_into('!II', cab, ihl+4, seq & 0xffffffff, ack & 0xffffffff)
+        struct.pack_into('!H', cab, ihl+14, win & 0xffff)
+        struct.pack_into('!H', cab, ihl+18, urp)
+        dados = quadro[i:]
+        struct.pack_into('!HH', cab, 2, hlen + len(dados), ident & 0xffff)
+        struct.pack_into('!H', cab, 10, 0)
+        struct.pack_into('!H', cab, 10, calc_checksum(bytes(cab[:ihl])))
+        self.rx[cid] = bytes(cab)
+        cab += dados
+        return cab
+
+    def erro(self):
+        """
+        Deve ser chamado quando a camada de enlace detectar um quadro
+        corrompido: os pacotes comprimidos seguintes são descartados até que
+        chegue um que identifique explicitamente o seu slot.
+        """
+        self.descartar = True
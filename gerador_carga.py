@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Gerador de carga para servidores TCP, como o eco de placa3.py, usando a
+nossa própria pilha (tcp.Cliente) em vez da do Linux. Abre N conexões
+simultâneas e, em cada uma, executa um dos padrões:
+
+ * eco: envia requisições de --tamanho bytes, uma por vez, esperando
+   --resposta bytes de volta antes da próxima (mede a latência de cada uma);
+ * bulk: envia --tamanho bytes de uma vez com enviar_stream e espera
+   --resposta bytes de volta.
+
+Ao final reporta a vazão, os percentis de latência e as retransmissões.
+
+Por padrão o servidor de eco roda neste mesmo processo, ligado ao cliente
+por uma LinhaVirtual, de forma que as duas pontas usam a nossa pilha. Com
+--linha pty ou --linha zybo:N a carga sai por uma linha serial de verdade
+até um servidor em outra placa.
+
+Uso: python3 gerador_carga.py [--conexoes N] [--padrao eco|bulk] ... (vide --help)
+"""
+import time
+import asyncio
+import argparse
+from ip import IP
+from slip import CamadaEnlace
+from tcp import Cliente, Servidor
+from camadafisica import LinhaVirtual, PTY
+
+
+class Recepcao:
+    """ Conta os bytes recebidos por uma conexão e acorda quem os espera """
+    def __init__(self):
+        self.recebidos = 0
+        self.alvo = 0
+        self.espera = None
+        self.fim = asyncio.get_event_loop().create_future()
+
+    def __call__(self, conexao, dados):
+        if dados == b'':
+            if not self.fim.done():
+                self.fim.set_result(None)
+            self._acordar(ConnectionResetError('a outra ponta fechou a conexão'))
+            return
+        self.recebidos += len(dados)
+        if self.recebidos >= self.alvo:
+            self._acordar()
+
+    def _acordar(self, erro=None):
+        espera, self.espera = self.espera, None
+        if espera is not None and not espera.done():
+            if erro is None:
+                espera.set_result(None)
+            else:
+                espera.set_exception(erro)
+
+    async def aguardar(self, n):
+        """ Espera até que mais n bytes tenham sido recebidos """
+        self.alvo += n
+        if self.recebidos < self.alvo:
+            if self.fim.done():
+                raise ConnectionResetError('a outra ponta fechou a conexão')
+            self.espera = asyncio.get_event_loop().create_future()
+            await self.espera
+
+
+class Estatisticas:
+    def __init__(self):
+        self.abertas = 0
+        self.falhas = 0
+        self.requisicoes = 0
+        self.enviados = 0
+        self.recebidos = 0
+        self.retransmissoes = 0
+        self.aberturas = []   # duração de cada handshake
+        self.latencias = []   # duração de cada requisição (ou transferência, no bulk)
+
+
+def percentil(amostras, p):
+    if not amostras:
+        return float('nan')
+    amostras = sorted(amostras)
+    return amostras[min(len(amostras) - 1, int(p / 100 * len(amostras)))]
+
+
+async def blocos(total, tamanho=1 << 16):
+    bloco = b'x' * tamanho
+    while total > 0:
+        yield bloco[:total]
+        total -= tamanho
+
+
+async def sessao(cliente, args, est):
+    inicio = time.perf_counter()
+    try:
+        conexao = await cliente.conectar(args.destino, args.porta)
+    except (ConnectionError, TimeoutError, OSError) as e:
+        print('falha ao conectar: %s' % e)
+        est.falhas += 1
+        return
+    est.aberturas.append(time.perf_counter() - inicio)
+    est.abertas += 1
+    recepcao = Recepcao()
+    conexao.registrar_recebedor(recepcao)
+    try:
+        if args.padrao == 'eco':
+            mensagem = b'x' * args.tamanho
+            for _ in range(args.requisicoes):
+                inicio = time.perf_counter()
+                conexao.enviar(mensagem)
+                await recepcao.aguardar(args.resposta)
+                est.latencias.append(time.perf_counter() - inicio)
+                est.requisicoes += 1
+                est.enviados += args.tamanho
+        else:
+            inicio = time.perf_counter()
+            enviados = await conexao.enviar_stream(blocos(args.tamanho))
+            est.enviados += enviados
+            await recepcao.aguardar(args.resposta)
+            est.latencias.append(time.perf_counter() - inicio)
+            est.requisicoes += 1
+        conexao.fechar()
+        await asyncio.wait_for(asyncio.shield(recepcao.fim), args.espera_fim)
+    except (ConnectionError, asyncio.TimeoutError) as e:
+        print('conexão %s:%d interrompida: %s' % (conexao.id_conexao[2:] + (e,)))
+        est.falhas += 1
+    finally:
+        est.recebidos += recepcao.recebidos
+        est.retransmissoes += conexao.retransmissoes
+
+
+def eco(conexao, dados):
+    # Mesma aplicação de placa3.py
+    if dados == b'':
+        conexao.fechar()
+    else:
+        conexao.enviar(dados)
+
+
+def montar_rede(args):
+    """ Monta a pilha do cliente e, no modo local, a do servidor de eco """
+    aceitas, simuladas = [], []
+    if args.linha == 'local':
+        ponta_cliente, ponta_servidor = LinhaVirtual.par()
+        rede_servidor = IP(CamadaEnlace({args.origem: ponta_servidor}))
+        rede_servidor.definir_endereco_host(args.destino)
+        rede_servidor.definir_tabela_encaminhamento([('0.0.0.0/0', args.origem)])
+        servidor = Servidor(rede_servidor, args.porta, lote=args.lote)
+        servidor.max_conexoes = max(servidor.max_conexoes, 2 * args.conexoes)
+
+        def aceitar(conexao):
+            conexao.registrar_recebedor(eco)
+            aceitas.append(conexao)
+        servidor.registrar_monitor_de_conexoes_aceitas(aceitar)
+        linha = ponta_cliente
+        simuladas += [ponta_cliente, ponta_servidor]
+    elif args.linha == 'pty':
+        linha = PTY()
+        print('Linha serial disponível em:', linha.pty_name)
+    elif args.linha.startswith('zybo:'):
+        from camadafisica import ZyboSerialDriver
+        linha = ZyboSerialDriver().obter_porta(int(args.linha[5:]))
+    else:
+        raise SystemExit('linha desconhecida: %s' % args.linha)
+
+    rede = IP(CamadaEnlace({args.destino: linha}))
+    rede.definir_endereco_host(args.origem)
+    rede.definir_tabela_encaminhamento([('0.0.0.0/0', args.destino)])
+    return Cliente(rede, lote=args.lote), aceitas, simuladas
+
+
+def relatorio(args, est, duracao, cliente, aceitas, simuladas):
+    ms = lambda segundos: 1e3 * segundos
+    print('conexões: %d abertas, %d falhas; handshake p50 %.2f ms, p99 %.2f ms' %
+          (est.abertas, est.falhas, ms(percentil(est.aberturas, 50)), ms(percentil(est.aberturas, 99))))
+    print('%s: %d em %.2f s (%.1f/s)' % ('requisições' if args.padrao == 'eco' else 'transferências',
+                                         est.requisicoes, duracao, est.requisicoes / duracao))
+    print('latência: p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, máx %.2f ms' %
+          tuple(ms(percentil(est.latencias, p)) for p in (50, 90, 99, 100)))
+    print('vazão: %.0f B/s enviados, %.0f B/s recebidos' %
+          (est.enviados / duracao, est.recebidos / duracao))
+    linha = 'retransmissões: %d SYN, %d de dados pelo cliente' % \
+        (cliente.retransmissoes_syn, est.retransmissoes)
+    if args.linha == 'local':
+        linha += ', %d pelo servidor' % sum(conexao.retransmissoes for conexao in aceitas)
+    print(linha)
+    if simuladas:
+        print('quadros descartados por buffer cheio na LinhaVirtual: %d' %
+              sum(ponta.descartados for ponta in simuladas))
+
+
+async def main(args):
+    if args.resposta is None:
+        args.resposta = args.tamanho
+    cliente, aceitas, simuladas = montar_rede(args)
+    if args.linha == 'pty':
+        input('Pressione ENTER quando a outra ponta estiver pronta...')
+    est = Estatisticas()
+    inicio = time.perf_counter()
+    await asyncio.gather(*(sessao(cliente, args, est) for _ in range(args.conexoes)))
+    relatorio(args, est, time.perf_counter() - inicio, cliente, aceitas, simuladas)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Gerador de carga para servidores TCP')
+    parser.add_argument('--conexoes', type=int, default=10, help='conexões simultâneas')
+    parser.add_argument('--padrao', choices=('eco', 'bulk'), default='eco')
+    parser.add_argument('--tamanho', type=int, default=64,
+                        help='bytes por requisição (eco) ou por conexão (bulk)')
+    parser.add_argument('--resposta', type=int, default=None,
+                        help='bytes esperados de volta (padrão: o mesmo que --tamanho)')
+    parser.add_argument('--requisicoes', type=int, default=100, help='requisições por conexão (eco)')
+    parser.add_argument('--linha', default='local', help='local, pty ou zybo:N')
+    parser.add_argument('--origem', default='192.168.200.3', help='endereço IP desta ponta')
+    parser.add_argument('--destino', default='192.168.200.4', help='endereço IP do servidor')
+    parser.add_argument('--porta', type=int, default=7000)
+    parser.add_argument('--lote', action='store_true', help='processa os segmentos em lote')
+    parser.add_argument('--espera-fim', type=float, default=10,
+                        help='segundos esperando o FIN do servidor ao final de cada conexão')
+    asyncio.run(main(parser.parse_args()))
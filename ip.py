@@ -1,5 +1,6 @@
 import struct
 import random
+import traceback
 from iputils import calc_checksum, str2addr  # Certifique-se de ter uma função calc_checksum implementada em iputils.py
 from iputils import read_ipv4_header  # Certifique-se de ter uma função de leitura de cabeçalho IPv4 em iputils.py
 
@@ -11,6 +12,7 @@ class IP:
         Ethernet com ARP).
         """
         self.callback = None
+        self.callback_lote = None
         self.enlace = enlace
         self.enlace.registrar_recebedor(self.__raw_recv)
         self.ignore_checksum = self.enlace.ignore_checksum
@@ -19,12 +21,31 @@ class IP:
         self.proximidade = -1
         self.identificador = 0
 
-    def __raw_recv(self, datagrama):
+    def __raw_recv_lote(self, datagramas):
+        segmentos = []
+        raw_recv = self.__raw_recv
+        for datagrama in datagramas:
+            try:
+                raw_recv(datagrama, segmentos)
+            except Exception:
+                traceback.print_exc()
+        if segmentos:
+            self.callback_lote(segmentos)
+
+    def __raw_recv(self, datagrama, segmentos=None):
+        # datagrama normalmente é uma memoryview entregue pela camada de enlace;
+        # o payload repassado ao TCP é uma fatia dela, sem cópia.
         dscp, ecn, identificacao, flags, frag_offset, ttl, proto, \
         src_addr, dst_addr, payload = read_ipv4_header(datagrama)
 
         if dst_addr == self.endereco_host:
-            if proto == 6 and self.callback:  # 6 é o número de protocolo para TCP
+            if proto != 6:  # 6 é o número de protocolo para TCP
+                return
+            if segmentos is not None:
+                segmentos.append((src_addr, dst_addr, payload))
+            elif self.callback_lote:
+                self.callback_lote([(src_addr, dst_addr, payload)])
+            elif self.callback:
                 self.callback(src_addr, dst_addr, payload)
         else:
             # Atua como roteador
@@ -32,7 +53,7 @@ class IP:
             proximo_salto = self._next_hop(dst_addr)
             
             # Extrai campos do cabeçalho IP
-            ver_ihl, dscpecn, comprimento, _, flg_offset, _, proto_num, head_chk, ip_src, ip_dst = struct.unpack('!BBHHHBBHII', datagrama[:20])
+            ver_ihl, dscpecn, comprimento, _, flg_offset, _, proto_num, head_chk, ip_src, ip_dst = struct.unpack_from('!BBHHHBBHII', datagrama)
             campos_cabecalho = [ver_ihl, dscpecn, comprimento, self.identificador, flg_offset, ttl, proto_num, 0, ip_src, ip_dst]
             
             # Verifica e ajusta o campo TTL
@@ -121,6 +142,17 @@ class IP:
         """
         self.callback = callback
 
+    def registrar_recebedor_lote(self, callback):
+        """
+        Registra uma função para ser chamada com uma lista de tuplas
+        (src_addr, dst_addr, segmento) com todos os segmentos destinados a este
+        host que a camada de enlace entregar de uma só vez. Substitui a
+        entrega feita via registrar_recebedor.
+        """
+        self.callback_lote = callback
+        if hasattr(self.enlace, 'registrar_recebedor_lote'):
+            self.enlace.registrar_recebedor_lote(self.__raw_recv_lote)
+
     def enviar(self, segmento, dest_addr):
         """
         Envia segmento para dest_addr, onde dest_addr é um endereço IPv4
@@ -150,7 +182,7 @@ class IP:
             src_ip, = struct.unpack('!I', str2addr(self.endereco_host))
             dst_ip, = struct.unpack('!I', str2addr(dest_addr))
 
-            self.identificador += comprimento
+            self.identificador = (self.identificador + comprimento) & 0xffff
         else:
             ver_ihl, dscpecn, comprimento, identificador, flg_offset, ttl, protocolo, header_checksum, src_ip, dst_ip = campos_cabecalho
             ttl -= 1  # Decrementa o TTL
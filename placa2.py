@@ -1,4 +1,8 @@
 #!/usr/bin/env python3
+# Uso: python3 placa2.py [trabalhadores]
+#   Com mais de um trabalhador, o encaminhamento é dividido entre vários
+#   processos (vide roteador.py), um por núcleo disponível, por exemplo.
+import sys
 import asyncio
 from camadafisica import ZyboSerialDriver
 from ip import IP               # copie o arquivo do T3
@@ -10,14 +14,24 @@ driver = ZyboSerialDriver()
 serial1 = driver.obter_porta(0)
 serial2 = driver.obter_porta(4)
 
-enlace = CamadaEnlace({'192.168.200.4': serial1,
-                       '192.168.200.2': serial2,})
-
-rede = IP(enlace)
-rede.definir_endereco_host('192.168.200.3')
-rede.definir_tabela_encaminhamento([
+linhas_seriais = {'192.168.200.4': serial1,
+                  '192.168.200.2': serial2,}
+endereco_host = '192.168.200.3'
+tabela = [
     ('192.168.200.0/24', '192.168.200.2'),
     ('192.168.200.4/32', '192.168.200.4'),
-])
+]
+trabalhadores = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+
+if trabalhadores > 1:
+    from roteador import RoteadorMultiprocesso
+    roteador = RoteadorMultiprocesso(linhas_seriais, endereco_host, tabela, trabalhadores)
+    roteador.iniciar()   # este processo continua lendo a fila do hardware e despachando
+else:
+    enlace = CamadaEnlace(linhas_seriais)
+
+    rede = IP(enlace)
+    rede.definir_endereco_host(endereco_host)
+    rede.definir_tabela_encaminhamento(tabela)
 
 asyncio.get_event_loop().run_forever()
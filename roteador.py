@@ -0,0 +1,388 @@
+"""
+Modo multiprocesso para o papel de roteador (vide placa2.py).
+
+As portas seriais são divididas entre vários processos trabalhadores, cada
+um com o seu próprio laço de eventos, CamadaEnlace e IP, de forma que o
+encaminhamento não fica preso a um único núcleo pelo GIL. Quando o próximo
+salto de um datagrama está numa porta de outro trabalhador, o datagrama é
+passado a ele por um anel em memória compartilhada. A tabela de
+encaminhamento é compilada uma única vez e compartilhada, somente para
+leitura, por todos os trabalhadores.
+
+Portas que podem ser lidas de forma independente (PTY, LinhaVirtual) são
+lidas diretamente pelo trabalhador que as possui. O ZyboSerialDriver entrega
+todas as portas numa única fila de hardware, então o processo pai continua
+atendendo as interrupções e age como despachante: os bytes de cada porta
+seguem, por um anel, para o trabalhador dono dela, que transmite
+diretamente pelo registrador da porta.
+"""
+import os
+import struct
+import asyncio
+import functools
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+from ip import IP
+from slip import CamadaEnlace
+from camadafisica import ZyboSerialPort
+from iputils import str2addr, addr2str
+
+TAMANHO_ANEL = 1 << 20
+
+
+class Anel:
+    """
+    Fila circular de registros em memória compartilhada, com um único
+    processo produtor e um único consumidor e sem travas.
+
+    Os registros ficam na memória compartilhada, mas os índices não: o
+    produtor envia a nova cabeça pela campainha (um pipe) e o consumidor
+    devolve a nova cauda por outro pipe. Como o kernel ordena a escrita e a
+    leitura de um pipe, o consumidor só enxerga uma cabeça depois que os
+    bytes dos registros anteriores a ela estão visíveis, e o produtor só
+    reaproveita o espaço depois que o consumidor terminou de copiá-lo. Isso
+    vale também em processadores com ordenação fraca de memória, como o ARM
+    da Zynq, onde publicar a cabeça na própria memória compartilhada exigiria
+    uma barreira que o Python não oferece.
+    """
+    PULO = 0xffffffff    # marca que o restante até o fim do anel não foi usado
+
+    def __init__(self, capacidade=TAMANHO_ANEL):
+        self.shm = shared_memory.SharedMemory(create=True, size=capacidade)
+        self.buf = self.shm.buf
+        self.capacidade = capacidade
+        self.campainha_r, self.campainha_w = os.pipe()   # cabeças, do produtor ao consumidor
+        self.retorno_r, self.retorno_w = os.pipe()       # caudas, do consumidor ao produtor
+        for fd in (self.campainha_r, self.campainha_w, self.retorno_r, self.retorno_w):
+            os.set_blocking(fd, False)
+        # Contadores de bytes que só crescem. Cada processo usa apenas os seus:
+        self.cabeca = 0          # produtor: fim do último registro escrito
+        self.cauda_vista = 0     # produtor: última cauda recebida do consumidor
+        self.cauda = 0           # consumidor: fim do último registro lido
+        self.cabeca_vista = 0    # consumidor: última cabeça recebida do produtor
+        self.descartados = 0
+
+    @staticmethod
+    def _ultimo_contador(fd, atual):
+        # Cada escrita no pipe é um contador de 8 bytes; só o mais recente importa
+        try:
+            while True:
+                dados = os.read(fd, 4096)
+                if not dados:
+                    break
+                atual, = struct.unpack_from('Q', dados, len(dados) - 8)
+        except BlockingIOError:
+            pass
+        return atual
+
+    def escrever(self, *partes):
+        """
+        Acrescenta ao anel um registro formado pela concatenação das partes.
+        Devolve False (e descarta o registro) se não houver espaço. O
+        registro só fica visível ao consumidor depois de tocar().
+        """
+        n = 4 + sum(len(parte) for parte in partes)
+        pos = self.cabeca % self.capacidade
+        resto = self.capacidade - pos
+        pulo = resto if resto < n else 0
+        if pulo + n > self.capacidade - (self.cabeca - self.cauda_vista):
+            self.cauda_vista = self._ultimo_contador(self.retorno_r, self.cauda_vista)
+            if pulo + n > self.capacidade - (self.cabeca - self.cauda_vista):
+                self.descartados += 1
+                return False
+        buf = self.buf
+        if pulo:
+            # O registro não cabe antes do fim: continua no começo do anel
+            if resto >= 4:
+                struct.pack_into('I', buf, pos, self.PULO)
+            self.cabeca += pulo
+            pos = 0
+        struct.pack_into('I', buf, pos, n - 4)
+        i = pos + 4
+        for parte in partes:
+            buf[i:i+len(parte)] = parte
+            i += len(parte)
+        self.cabeca += n
+        return True
+
+    def tocar(self):
+        """
+        Publica ao consumidor todos os registros já escritos e o acorda.
+        Devolve False se a campainha estiver cheia, e então precisa ser
+        chamado de novo.
+        """
+        self.cauda_vista = self._ultimo_contador(self.retorno_r, self.cauda_vista)
+        try:
+            os.write(self.campainha_w, struct.pack('Q', self.cabeca))
+        except BlockingIOError:
+            return False
+        return True
+
+    def ler(self):
+        """
+        Atende a campainha e devolve a lista de registros publicados desde a
+        última leitura, liberando o espaço deles para o produtor
+        """
+        self.cabeca_vista = self._ultimo_contador(self.campainha_r, self.cabeca_vista)
+        buf = self.buf
+        cauda = self.cauda
+        registros = []
+        while cauda < self.cabeca_vista:
+            pos = cauda % self.capacidade
+            resto = self.capacidade - pos
+            if resto < 4:
+                cauda += resto
+                continue
+            n, = struct.unpack_from('I', buf, pos)
+            if n == self.PULO:
+                cauda += resto
+                continue
+            registros.append(bytes(buf[pos+4:pos+4+n]))
+            cauda += 4 + n
+        if cauda != self.cauda:
+            self.cauda = cauda
+            try:
+                os.write(self.retorno_w, struct.pack('Q', cauda))
+            except BlockingIOError:
+                pass    # o produtor está atrasado; a próxima leitura publica a cauda
+        return registros
+
+    def destruir(self):
+        self.buf = None
+        self.shm.close()
+        self.shm.unlink()
+        for fd in (self.campainha_r, self.campainha_w, self.retorno_r, self.retorno_w):
+            os.close(fd)
+
+
+class Campainhas:
+    """
+    Toca a campainha de cada anel escrito no máximo uma vez por iteração do
+    laço de eventos, tentando de novo as que estiverem cheias
+    """
+    def __init__(self):
+        self.aneis = set()
+
+    def marcar(self, anel):
+        if not self.aneis:
+            asyncio.get_event_loop().call_soon(self._tocar)
+        self.aneis.add(anel)
+
+    def _tocar(self):
+        self.aneis = {anel for anel in self.aneis if not anel.tocar()}
+        if self.aneis:
+            asyncio.get_event_loop().call_later(0.001, self._tocar)
+
+
+class TabelaCompilada:
+    """
+    Tabela de encaminhamento em memória compartilhada. Cada rota é guardada
+    como quatro inteiros de 32 bits (prefixo, máscara, próximo salto, tamanho
+    do prefixo), em ordem decrescente de tamanho do prefixo, de forma que a
+    primeira rota que casar é a mais específica.
+    """
+    def __init__(self, tabela):
+        rotas = []
+        for cidr, next_hop in tabela:
+            endereco, bits = cidr.split('/')
+            bits = int(bits)
+            mascara = (0xffffffff << (32 - bits)) & 0xffffffff
+            prefixo = int.from_bytes(str2addr(endereco), 'big') & mascara
+            rotas.append((bits, prefixo, mascara, int.from_bytes(str2addr(next_hop), 'big')))
+        rotas.sort(key=lambda rota: rota[0], reverse=True)
+        self.tamanho = 16 * len(rotas)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(16, self.tamanho))
+        for i, (bits, prefixo, mascara, next_hop) in enumerate(rotas):
+            struct.pack_into('IIII', self.shm.buf, 16*i, prefixo, mascara, next_hop, bits)
+
+    def consultar(self, dest_addr):
+        """
+        Devolve o próximo salto (string no formato x.y.z.w) e o tamanho do
+        prefixo da rota mais específica para dest_addr, ou (None, -1)
+        """
+        destino = int.from_bytes(str2addr(dest_addr), 'big')
+        for prefixo, mascara, next_hop, bits in struct.iter_unpack('IIII', self.shm.buf[:self.tamanho]):
+            if destino & mascara == prefixo:
+                return addr2str(next_hop.to_bytes(4, 'big')), bits
+        return None, -1
+
+    def destruir(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class IPTrabalhador(IP):
+    """ IP que consulta a tabela compilada compartilhada """
+    def __init__(self, enlace, tabela):
+        super().__init__(enlace)
+        self.tabela = tabela
+
+    def _next_hop(self, dest_addr):
+        next_hop, bits = self.tabela.consultar(dest_addr)
+        if next_hop is not None:
+            self.proximidade = bits
+        return next_hop
+
+
+class EnlaceTrabalhador:
+    """
+    Camada de enlace vista pelo IP de um trabalhador. Os next_hop das portas
+    deste processo são atendidos pela CamadaEnlace local e os demais são
+    repassados, pelo anel correspondente, ao trabalhador dono da porta.
+    """
+    def __init__(self, local, donos, saidas):
+        self.local = local
+        self.donos = donos
+        self.saidas = saidas
+        self.ignore_checksum = local.ignore_checksum
+        self.campainhas = Campainhas()
+
+    def registrar_recebedor(self, callback):
+        self.local.registrar_recebedor(callback)
+
+    def registrar_recebedor_lote(self, callback):
+        self.local.registrar_recebedor_lote(callback)
+
+    def enviar(self, datagrama, next_hop):
+        if next_hop in self.local.enlaces:
+            self.local.enviar(datagrama, next_hop)
+            return
+        anel = self.saidas[self.donos[next_hop]]
+        if anel.escrever(str2addr(next_hop), datagrama):
+            self.campainhas.marcar(anel)
+
+
+class PortaDespachada:
+    """
+    Porta de um ZyboSerialDriver usada por um trabalhador. Os bytes recebidos
+    chegam pelo anel do despachante, que é o único processo que lê a fila de
+    hardware; a transmissão é feita diretamente pelo registrador da porta,
+    que fica no mapeamento do dispositivo herdado do processo pai.
+    """
+    def __init__(self, driver, port):
+        self.driver = driver
+        self.port = port
+        self.callback = None
+        self.callback_lote = None
+
+    def registrar_recebedor(self, callback):
+        self.callback = callback
+
+    def registrar_recebedor_lote(self, callback):
+        self.callback_lote = callback
+
+    def enviar(self, dados):
+        self.driver.enviar(self.port, dados)
+
+    def _entregar(self, blocos):
+        if self.callback_lote:
+            self.callback_lote(blocos)
+        elif self.callback:
+            for dados in blocos:
+                self.callback(dados)
+
+
+def _despachar(anel, campainhas, port, blocos):
+    # Executado no processo pai, a cada interrupção do ZyboSerialDriver
+    for dados in blocos:
+        anel.escrever(bytes((port,)), dados)
+    campainhas.marcar(anel)
+
+
+def _atender(anel, enlace):
+    for registro in anel.ler():
+        enlace.enviar(registro[4:], addr2str(registro[:4]))
+
+
+def _receber_despacho(anel, portas):
+    blocos = {}
+    for registro in anel.ler():
+        blocos.setdefault(registro[0], []).append(registro[1:])
+    for port, lista in blocos.items():
+        try:
+            portas[port]._entregar(lista)
+        except Exception:
+            traceback.print_exc()
+
+
+def _trabalhar(indice, linhas_seriais, donos, aneis, despacho, tabela, endereco_host, cslip):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    minhas, portas = {}, {}
+    for ip, linha in linhas_seriais.items():
+        if donos[ip] != indice:
+            continue
+        if isinstance(linha, ZyboSerialPort):
+            linha = portas[linha.port] = PortaDespachada(linha.driver, linha.port)
+        elif callable(linha):
+            linha = linha()
+        minhas[ip] = linha
+    local = CamadaEnlace(minhas, cslip)
+    saidas = {j: anel for (i, j), anel in aneis.items() if i == indice}
+    rede = IPTrabalhador(EnlaceTrabalhador(local, donos, saidas), tabela)
+    rede.definir_endereco_host(endereco_host)
+    for (i, j), anel in aneis.items():
+        if j == indice:
+            loop.add_reader(anel.campainha_r, _atender, anel, local)
+    if portas:
+        loop.add_reader(despacho[indice].campainha_r, _receber_despacho, despacho[indice], portas)
+    loop.run_forever()
+
+
+class RoteadorMultiprocesso:
+    def __init__(self, linhas_seriais, endereco_host, tabela, trabalhadores=2, cslip=False):
+        """
+        Os argumentos linhas_seriais e cslip têm o mesmo formato usado pela
+        CamadaEnlace, e tabela o formato usado por
+        IP.definir_tabela_encaminhamento. As linhas seriais que precisam ser
+        criadas dentro do processo que vai usá-las (como a PTY, que se
+        registra no laço de eventos ao ser construída) podem ser passadas
+        como funções sem argumentos que as constroem. Portas de um
+        ZyboSerialDriver são lidas pelo processo que chamar iniciar(), cujo
+        laço de eventos precisa continuar rodando, e despachadas aos
+        trabalhadores.
+        """
+        self.linhas_seriais = linhas_seriais
+        self.endereco_host = endereco_host
+        self.cslip = cslip
+        self.trabalhadores = trabalhadores
+        # As portas são distribuídas entre os trabalhadores em rodízio
+        self.donos = {ip: i % trabalhadores for i, ip in enumerate(linhas_seriais)}
+        self.tabela = TabelaCompilada(tabela)
+        self.aneis = {(i, j): Anel() for i in range(trabalhadores)
+                      for j in range(trabalhadores) if i != j}
+        # Anéis do despachante (processo pai) para cada trabalhador com portas da Zybo
+        self.despacho = {self.donos[ip]: None for ip, linha in linhas_seriais.items()
+                         if isinstance(linha, ZyboSerialPort)}
+        for indice in self.despacho:
+            self.despacho[indice] = Anel()
+        self.campainhas = Campainhas()
+        self.processos = []
+
+    def iniciar(self):
+        """ Inicia os processos trabalhadores e, se for o caso, o despachante """
+        contexto = multiprocessing.get_context('fork')
+        for indice in range(self.trabalhadores):
+            processo = contexto.Process(target=_trabalhar, daemon=True,
+                                        args=(indice, self.linhas_seriais, self.donos, self.aneis,
+                                              self.despacho, self.tabela, self.endereco_host,
+                                              self.cslip))
+            processo.start()
+            self.processos.append(processo)
+        for ip, linha in self.linhas_seriais.items():
+            if isinstance(linha, ZyboSerialPort):
+                anel = self.despacho[self.donos[ip]]
+                linha.driver.registrar_recebedor_lote(
+                    linha.port, functools.partial(_despachar, anel, self.campainhas, linha.port))
+
+    def parar(self):
+        """ Encerra os trabalhadores e libera a memória compartilhada """
+        for processo in self.processos:
+            processo.terminate()
+        for processo in self.processos:
+            processo.join()
+        self.processos.clear()
+        for anel in list(self.aneis.values()) + list(self.despacho.values()):
+            anel.destruir()
+        self.tabela.destruir()
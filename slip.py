@@ -1,7 +1,12 @@
+import asyncio
+import traceback
+from cslip import CompressorVJ, TYPE_UNCOMPRESSED_TCP
+
+
 class CamadaEnlace:
     ignore_checksum = False
 
-    def __init__(self, linhas_seriais):
+    def __init__(self, linhas_seriais, cslip=False):
         """
         Inicia uma camada de enlace com um ou mais enlaces, cada um conectado
         a uma linha serial distinta. O argumento linhas_seriais é um dicionário
@@ -10,12 +15,21 @@ class CamadaEnlace:
         uma string no formato 'x.y.z.w'. A linha_serial é um objeto da classe
         PTY (vide camadafisica.py) ou de outra classe que implemente os métodos
         registrar_recebedor e enviar.
+
+        O argumento cslip liga a compressão de cabeçalhos TCP/IP (RFC 1144)
+        e pode ser False, True ou 'adaptativo' (o modo adaptive do Linux: só
+        comprime depois de receber um pacote comprimido da outra ponta). Para
+        configurar cada enlace separadamente, passe um dicionário no formato
+        {ip_outra_ponta: modo}.
         """
         self.enlaces = {}
         self.callback = None
+        self.callback_lote = None
+        self.pendentes = []
         # Constrói um Enlace para cada linha serial
         for ip_outra_ponta, linha_serial in linhas_seriais.items():
-            enlace = Enlace(linha_serial)
+            modo = cslip.get(ip_outra_ponta, False) if isinstance(cslip, dict) else cslip
+            enlace = Enlace(linha_serial, modo)
             self.enlaces[ip_outra_ponta] = enlace
             enlace.registrar_recebedor(self._callback)
 
@@ -25,6 +39,16 @@ class CamadaEnlace:
         """
         self.callback = callback
 
+    def registrar_recebedor_lote(self, callback):
+        """
+        Registra uma função para ser chamada com a lista de todos os datagramas
+        recebidos, em qualquer um dos enlaces, durante uma mesma iteração do
+        laço de eventos. Substitui a entrega feita via registrar_recebedor.
+        """
+        self.callback_lote = callback
+        for enlace in self.enlaces.values():
+            enlace.registrar_recebedor_lote(self._callback_lote)
+
     def enviar(self, datagrama, next_hop):
         """
         Envia datagrama para next_hop, onde next_hop é um endereço IPv4
@@ -38,34 +62,118 @@ class CamadaEnlace:
         if self.callback:
             self.callback(datagrama)
 
+    def _callback_lote(self, datagramas):
+        # Acumula o que chegar de todos os enlaces e entrega tudo de uma vez
+        # assim que o laço de eventos terminar de atender a iteração atual
+        if not self.pendentes:
+            asyncio.get_event_loop().call_soon(self._entregar_lote)
+        self.pendentes += datagramas
+
+    def _entregar_lote(self):
+        pendentes, self.pendentes = self.pendentes, []
+        self.callback_lote(pendentes)
+
 
 class Enlace:
-    def __init__(self, linha_serial):
+    def __init__(self, linha_serial, cslip=False):
         self.linha_serial = linha_serial
         self.linha_serial.registrar_recebedor(self.__raw_recv)
-        self.buffer = b''
+        self.buffer = bytearray()
+        # Pacotes comprimidos são sempre aceitos; só comprimimos os que
+        # enviamos se o modo for True, ou 'adaptativo' depois que a outra
+        # ponta mostrar que também usa CSLIP.
+        self.cslip = cslip
+        self.compressor = CompressorVJ()
+        self.callback = None
+        self.callback_lote = None
 
     def registrar_recebedor(self, callback):
         self.callback = callback
 
+    def registrar_recebedor_lote(self, callback):
+        """
+        Registra uma função para receber de uma só vez a lista de datagramas
+        decodificados a partir de cada leitura da linha serial (ou de cada
+        lote de leituras, se a linha serial também oferecer essa interface).
+        """
+        self.callback_lote = callback
+        if hasattr(self.linha_serial, 'registrar_recebedor_lote'):
+            self.linha_serial.registrar_recebedor_lote(self.__raw_recv_lote)
+
     def enviar(self, datagrama):
+        if self.cslip is True:
+            datagrama = self.compressor.comprimir(datagrama)
         datagrama_codificado = datagrama.replace(b'\xDB', b'\xDB\xDD')\
                                         .replace(b'\xC0', b'\xDB\xDC')
         datagrama_completo = b'\xC0' + datagrama_codificado + b'\xC0'
         self.linha_serial.enviar(datagrama_completo)
 
     def __raw_recv(self, dados):
-        self.buffer += dados
-        quadros = self.buffer.split(b'\xC0')
-        self.buffer = quadros[-1]
-
-        for quadro in quadros[:-1]:
-            if quadro:
-                try:
-                    datagrama_decodificado = quadro.replace(b'\xDB\xDC', b'\xC0')\
-                                                   .replace(b'\xDB\xDD', b'\xDB')
-                    if self.callback:
-                        self.callback(datagrama_decodificado)
-                except Exception:
-                    import traceback
-                    traceback.print_exc()
+        if self.callback_lote:
+            self.__raw_recv_lote((dados,))
+            return
+        for datagrama in self.__quadros(dados):
+            try:
+                if self.callback:
+                    self.callback(datagrama)
+            except Exception:
+                traceback.print_exc()
+
+    def __raw_recv_lote(self, lista_dados):
+        quadros = self.__quadros
+        datagramas = [datagrama for dados in lista_dados for datagrama in quadros(dados)]
+        if datagramas:
+            try:
+                self.callback_lote(datagramas)
+            except Exception:
+                traceback.print_exc()
+
+    def __quadros(self, dados):
+        """
+        Gera os datagramas completos contidos em dados, juntando-os com o que
+        tiver sobrado da leitura anterior.
+        """
+        # Os quadros são entregues como memoryview sobre os próprios bytes
+        # recebidos da linha serial. Só copiamos quando um quadro chega
+        # dividido entre mais de uma leitura ou quando contém sequências de
+        # escape, que precisam ser decodificadas.
+        inicio = 0
+        while True:
+            fim = dados.find(b'\xC0', inicio)
+            if fim < 0:
+                break
+            if self.buffer:
+                self.buffer += memoryview(dados)[inicio:fim]
+                quadro, a, b = bytes(self.buffer), 0, len(self.buffer)
+                self.buffer.clear()
+            else:
+                quadro, a, b = dados, inicio, fim
+            inicio = fim + 1
+
+            if a == b:
+                continue
+            try:
+                escapes = quadro.count(b'\xDB', a, b)
+                if escapes:
+                    if escapes != quadro.count(b'\xDB\xDC', a, b) + quadro.count(b'\xDB\xDD', a, b):
+                        # Sequência de escape inválida: o quadro foi corrompido
+                        self.compressor.erro()
+                        continue
+                    quadro = quadro[a:b].replace(b'\xDB\xDC', b'\xC0')\
+                                        .replace(b'\xDB\xDD', b'\xDB')
+                    a, b = 0, len(quadro)
+                datagrama = memoryview(quadro)[a:b]
+                if datagrama[0] >= TYPE_UNCOMPRESSED_TCP:
+                    if self.cslip == 'adaptativo':
+                        self.cslip = True
+                    datagrama = self.compressor.descomprimir(datagrama)
+                    if datagrama is None:
+                        continue
+                    datagrama = memoryview(datagrama)
+            except Exception:
+                traceback.print_exc()
+                continue
+            yield datagrama
+
+        if inicio < len(dados):
+            self.buffer += memoryview(dados)[inicio:]
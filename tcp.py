@@ -1,16 +1,275 @@
+import os
+import mmap
+import struct
+import random
 import asyncio
-from time import time
+import hashlib
+import traceback
+from time import monotonic   # os prazos não podem saltar quando o NTP acerta o relógio da placa
+from collections import OrderedDict
 from tcputils import FLAGS_ACK, FLAGS_FIN, FLAGS_SYN, MSS, fix_checksum, make_header
 from tcputils import *
 
 
-class Servidor:
-    def __init__(self, rede, porta):
+# Limites da tabela de conexões do Servidor (podem ser ajustados por instância)
+MAX_SEMIABERTAS = 128   # SYNs aguardando o ACK final; acima disso usamos SYN cookies
+MAX_CONEXOES = 1024     # total de conexões na tabela (semiabertas + estabelecidas)
+TEMPO_SEMIABERTA = 30   # segundos até esquecer um SYN que não completou o handshake
+TEMPO_TIME_WAIT = 60    # 2*MSL
+MAX_TIME_WAIT = 1024    # entradas em TIME_WAIT; acima disso as mais antigas são esquecidas
+TEMPO_OCIOSO = 300      # segundos sem tráfego até uma conexão ser despejada
+TEMPO_VARREDURA = 1     # intervalo entre as coletas periódicas da tabela
+
+# Temporizador de retransmissão de uma Conexao (RFC 6298)
+RTO_MINIMO = 1          # a fila de uma linha serial lenta pode atrasar um ACK por centenas de ms
+RTO_MAXIMO = 60         # teto para o temporizador dobrado a cada retransmissão
+
+BLOCO = 1 << 16         # tamanho das leituras feitas pelos envios em fluxo
+PEDACO_CHECKSUM = 256   # bytes (número par) convertidos em inteiro de cada vez pelo checksum
+TAMANHO_CABECALHO = 20  # cabeçalho TCP sem opções, o menor segmento válido
+
+# Abertura ativa de conexões (Cliente)
+PORTAS_EFEMERAS = (49152, 65535)   # faixa de portas locais usadas por connect
+TEMPO_SYN = 1           # espera inicial pelo SYN+ACK, dobrada a cada retransmissão do SYN
+TENTATIVAS_SYN = 6      # SYNs enviados antes de desistir da conexão
+
+# Estados de uma Conexao
+ESTABELECIDA, FIN_WAIT, FIN_WAIT_2, CLOSE_WAIT, LAST_ACK, FECHADA = range(6)
+
+
+def soma_complemento(segment, src_addr, dst_addr):
+    """
+    Calcula, sem copiar o segmento (que pode ser uma memoryview), a soma em
+    complemento de um usada pelo checksum do TCP, incluindo o pseudocabeçalho.
+    Usa o fato de que essa soma das palavras de 16 bits equivale ao resto da
+    divisão por 0xffff do número inteiro formado pelos mesmos bytes. Como
+    2**16 deixa resto 1, o segmento pode ser convertido em pedaços de tamanho
+    par, cujos restos são somados: assim nenhum inteiro (nem o quociente da
+    divisão) chega perto do tamanho do segmento.
+    """
+    pseudohdr = str2addr(src_addr) + str2addr(dst_addr) + \
+        struct.pack('!HH', 0x0006, len(segment))
+    soma = int.from_bytes(pseudohdr, 'big')
+    segment = memoryview(segment)
+    par = len(segment) & ~1
+    for i in range(0, par, PEDACO_CHECKSUM):
+        soma += int.from_bytes(segment[i:min(i + PEDACO_CHECKSUM, par)], 'big') % 0xffff
+    if len(segment) & 1:
+        soma += segment[par] << 8   # completa a última palavra com um byte zero
+    return soma % 0xffff
+
+
+def checksum_valido(segment, src_addr, dst_addr):
+    """
+    Verifica o checksum de um segmento TCP recebido
+    """
+    return soma_complemento(segment, src_addr, dst_addr) == 0
+
+
+def montar_segmento(src_port, dst_port, seq_no, ack_no, flags, payload, src_addr, dst_addr):
+    """
+    Equivalente a fix_checksum(make_header(...) + payload, src_addr, dst_addr),
+    mas sem percorrer o segmento de dois em dois bytes.
+    """
+    segmento = bytearray(make_header(src_port, dst_port, seq_no, ack_no, flags))
+    segmento += payload
+    struct.pack_into('!H', segmento, 16, -soma_complemento(segmento, src_addr, dst_addr) % 0xffff)
+    return bytes(segmento)
+
+
+def seq_menor(a, b):
+    """
+    Compara dois números de sequência levando em conta a aritmética módulo 2**32
+    """
+    return ((a - b) & 0xffffffff) > 0x7fffffff
+
+
+class Demultiplexador:
+    """
+    Entrega cada segmento recebido pela camada de rede ao Servidor ou Cliente
+    dono da porta de destino, de forma que vários deles possam compartilhar
+    a mesma camada de rede, em qualquer ordem e em qualquer modo de entrega.
+    """
+    def __init__(self, rede):
+        self.rede = rede
+        self.donos = {}   # porta local -> (Servidor ou Cliente, recebe em lote)
+        self.lote = False
+        self.cliente = None   # Cliente compartilhado pelas chamadas a connect
+        self.rede.registrar_recebedor(self._rdt_rcv)
+
+    def registrar(self, porta, dono, lote=False):
+        lote = lote and hasattr(self.rede, 'registrar_recebedor_lote')
+        self.donos[porta] = (dono, lote)
+        if lote and not self.lote:
+            # A partir daqui a camada de rede só entrega em lote, inclusive
+            # para os donos que processam um segmento de cada vez
+            self.lote = True
+            self.rede.registrar_recebedor_lote(self._rdt_rcv_lote)
+
+    def remover(self, porta, dono):
+        if self.donos.get(porta, (None,))[0] is dono:
+            del self.donos[porta]
+
+    def _rdt_rcv(self, src_addr, dst_addr, segment):
+        if len(segment) < TAMANHO_CABECALHO:
+            return   # curto demais para ser um segmento TCP
+        dst_port, = struct.unpack_from('!H', segment, 2)
+        dono = self.donos.get(dst_port)
+        if dono is not None:
+            dono[0]._rdt_rcv(src_addr, dst_addr, segment)
+
+    def _rdt_rcv_lote(self, segmentos):
+        por_dono = {}
+        for segmento in segmentos:
+            if len(segmento[2]) < TAMANHO_CABECALHO:
+                # Curto demais para ser um segmento TCP; não pode impedir a
+                # entrega dos demais segmentos do lote
+                continue
+            dst_port, = struct.unpack_from('!H', segmento[2], 2)
+            dono = self.donos.get(dst_port)
+            if dono is not None:
+                por_dono.setdefault(dono, []).append(segmento)
+        for (dono, lote), lista in por_dono.items():
+            if lote:
+                dono._rdt_rcv_lote(lista)
+                continue
+            for src_addr, dst_addr, segment in lista:
+                try:
+                    dono._rdt_rcv(src_addr, dst_addr, segment)
+                except Exception:
+                    traceback.print_exc()
+
+
+def _demultiplexador(rede):
+    # Guardado na própria camada de rede (e não num dicionário do módulo),
+    # para que ela, o Demultiplexador e todas as conexões sobre ela possam
+    # ser coletados juntos quando a aplicação deixar de usá-la
+    demultiplexador = getattr(rede, 'demultiplexador_tcp', None)
+    if demultiplexador is None:
+        demultiplexador = rede.demultiplexador_tcp = Demultiplexador(rede)
+    return demultiplexador
+
+
+class Extremidade:
+    """
+    Parte comum ao Servidor e ao Cliente: a tabela de conexões
+    estabelecidas, as entradas em TIME_WAIT e a coleta periódica das que
+    expiram. As subclasses cuidam apenas da abertura das conexões (passiva
+    no Servidor, ativa no Cliente).
+    """
+    def __init__(self, rede):
         self.rede = rede
+        self.conexoes = OrderedDict()    # id_conexao -> Conexao, da menos para a mais recentemente ativa
+        self.time_wait = OrderedDict()   # id_conexao -> (prazo, seq_no, ack_no)
+        self.tempo_time_wait = TEMPO_TIME_WAIT
+        self.max_time_wait = MAX_TIME_WAIT
+        self.timer = None
+        self.lote = None   # durante um lote: conexões com ACKs pendentes
+
+    def _rdt_rcv_lote(self, segmentos):
+        self.lote = lote = {}
+        rdt_rcv = self._rdt_rcv
+        for src_addr, dst_addr, segment in segmentos:
+            try:
+                rdt_rcv(src_addr, dst_addr, segment)
+            except Exception:
+                traceback.print_exc()
+        self.lote = None
+        for conexao in lote:
+            conexao._fim_lote()
+
+    def _rst_rcv(self, id_conexao, conexao, seq_no, ack_no):
+        """
+        Trata o aborto da conexão pela outra ponta. Só aceitamos o RST se o
+        seu número de sequência for exatamente o próximo que esperamos, para
+        que não seja possível derrubar conexões alheias com RSTs forjados.
+        """
+        if conexao is not None:
+            if seq_no == conexao.ack_no:
+                self._abortar(conexao)
+        elif id_conexao in self.time_wait:
+            if seq_no == self.time_wait[id_conexao][2]:
+                self._esquecer_time_wait(id_conexao)
+
+    def _time_wait_rcv(self, id_conexao, flags):
+        if (flags & FLAGS_FIN) == FLAGS_FIN:
+            # O ACK do FIN se perdeu e a outra ponta retransmitiu o FIN
+            _, seq_envio, ack_envio = self.time_wait[id_conexao]
+            self._enviar_controle(id_conexao, seq_envio, ack_envio, FLAGS_ACK)
+
+    def _enviar_controle(self, id_conexao, seq_no, ack_no, flags):
+        src_addr, src_port, dst_addr, dst_port = id_conexao
+        segmento = montar_segmento(dst_port, src_port, seq_no, ack_no, flags, b'', src_addr, dst_addr)
+        self.rede.enviar(segmento, src_addr)
+
+    def _entrar_time_wait(self, conexao):
+        # A entrada é criada antes de remover a conexão, para que o Cliente
+        # saiba que a porta local continua em uso
+        self.time_wait[conexao.id_conexao] = (monotonic() + self.tempo_time_wait,
+                                              conexao.seq_envio, conexao.ack_no)
+        self._remover(conexao)
+        while len(self.time_wait) > self.max_time_wait:
+            # Esquecer um TIME_WAIT cedo só arrisca não reconfirmar um FIN
+            # retransmitido; não pode custar memória sem limite
+            self._esquecer_time_wait(next(iter(self.time_wait)))
+
+    def _esquecer_time_wait(self, id_conexao):
+        del self.time_wait[id_conexao]
+
+    def _remover(self, conexao):
+        self.conexoes.pop(conexao.id_conexao, None)
+        conexao._encerrar()
+
+    def _abortar(self, conexao):
+        estado = conexao.estado
+        self._remover(conexao)
+        if estado in (ESTABELECIDA, FIN_WAIT, FIN_WAIT_2) and conexao.callback:
+            # Avisa a aplicação, que ainda não tinha visto o fim da conexão
+            conexao.callback(conexao, b'')
+
+    def _coletar(self, agora):
+        """
+        Remove da tabela as entradas expiradas. Como cada dicionário está
+        ordenado pelo instante relevante, basta olhar o começo de cada um.
+        """
+        while self.time_wait:
+            id_conexao, (prazo, _, _) = next(iter(self.time_wait.items()))
+            if prazo > agora:
+                break
+            self._esquecer_time_wait(id_conexao)
+
+    def _pendente(self):
+        # Há entradas que podem expirar e, portanto, coletas a agendar?
+        return bool(self.time_wait)
+
+    def _agendar_coleta(self):
+        if self.timer is None and self._pendente():
+            self.timer = asyncio.get_event_loop().call_later(TEMPO_VARREDURA, self._varrer)
+
+    def _varrer(self):
+        self.timer = None
+        self._coletar(monotonic())
+        self._agendar_coleta()
+
+
+class Servidor(Extremidade):
+    def __init__(self, rede, porta, lote=False):
+        """
+        Se lote for verdadeiro e a camada de rede oferecer
+        registrar_recebedor_lote, os segmentos passam a ser processados em
+        lotes: cada conexão processa só o ACK mais recente do lote e envia um
+        único ACK pelos dados recebidos nele.
+        """
+        super().__init__(rede)
         self.porta = porta
-        self.conexoes = {}
+        self.semiabertas = OrderedDict() # id_conexao -> (seq_no, ack_no, instante) enquanto espera o ACK
+        self.max_semiabertas = MAX_SEMIABERTAS
+        self.max_conexoes = MAX_CONEXOES
+        self.tempo_semiaberta = TEMPO_SEMIABERTA
+        self.tempo_ocioso = TEMPO_OCIOSO
+        self.segredo = os.urandom(16)
         self.callback = None
-        self.rede.registrar_recebedor(self._rdt_rcv)
+        _demultiplexador(rede).registrar(porta, self, lote)
 
     def registrar_monitor_de_conexoes_aceitas(self, callback):
         """
@@ -20,132 +279,544 @@ class Servidor:
         self.callback = callback
 
     def _rdt_rcv(self, src_addr, dst_addr, segment):
+        # segment normalmente é uma memoryview sobre o quadro recebido pela
+        # camada de enlace; o payload só é copiado ao ser entregue à aplicação.
         src_port, dst_port, seq_no, ack_no, \
-            flags, window_size, checksum, urg_ptr = read_header(segment)
+            flags, window_size, checksum, urg_ptr = struct.unpack_from('!HHIIHHHH', segment)
 
         if dst_port != self.porta:
             # Ignora segmentos que não são destinados à porta do nosso servidor
             return
-        if not self.rede.ignore_checksum and calc_checksum(segment, src_addr, dst_addr) != 0:
+        if not self.rede.ignore_checksum and not checksum_valido(segment, src_addr, dst_addr):
             print('descartando segmento com checksum incorreto')
             return
 
         payload = segment[4*(flags>>12):]
         id_conexao = (src_addr, src_port, dst_addr, dst_port)
+        agora = monotonic()
+        self._coletar(agora)
 
-        if (flags & FLAGS_SYN) == FLAGS_SYN:
+        conexao = self.conexoes.get(id_conexao)
+        if (flags & FLAGS_RST) == FLAGS_RST:
+            self._rst_rcv(id_conexao, conexao, seq_no, ack_no)
+        elif (flags & FLAGS_SYN) == FLAGS_SYN:
             # A flag SYN estar setada significa que é um cliente tentando estabelecer uma conexão nova
-            # TODO: talvez você precise passar mais coisas para o construtor de conexão
-            ack_no = seq_no + 1
-            conexao = self.conexoes[id_conexao] = Conexao(self, id_conexao, seq_no, ack_no)
-            # TODO: você precisa fazer o handshake aceitando a conexão. Escolha
-            # se você acha melhor
-            flags = FLAGS_SYN + FLAGS_ACK
-            newSegment = fix_checksum(make_header(dst_port, src_port, seq_no, ack_no, flags), src_addr, dst_addr)
-            self.rede.enviar(newSegment, src_addr)
-            # fazer aqui mesmo ou dentro da classe Conexao.
-            if self.callback:
-                self.callback(conexao)
-        elif id_conexao in self.conexoes:
+            if conexao is not None:
+                # SYN duplicado para uma conexão já estabelecida: apenas reafirma o estado atual
+                conexao._enviar_ack()
+            else:
+                self._syn_rcv(id_conexao, seq_no, agora)
+        elif conexao is not None:
             # Passa para a conexão adequada se ela já estiver estabelecida
-            self.conexoes[id_conexao]._rdt_rcv(seq_no, ack_no, flags, payload)
+            self.conexoes.move_to_end(id_conexao)
+            conexao.ultima_atividade = agora
+            conexao._rdt_rcv(seq_no, ack_no, flags, payload)
+        elif id_conexao in self.time_wait:
+            self._time_wait_rcv(id_conexao, flags)
+        elif (flags & FLAGS_ACK) == FLAGS_ACK and self._completar_handshake(id_conexao, seq_no, ack_no, agora):
+            conexao = self.conexoes[id_conexao]
+            conexao._rdt_rcv(seq_no, ack_no, flags, payload)
         else:
             print('%s:%d -> %s:%d (pacote associado a conexão desconhecida)' %
                   (src_addr, src_port, dst_addr, dst_port))
 
+        self._agendar_coleta()
+
+    def _rst_rcv(self, id_conexao, conexao, seq_no, ack_no):
+        if conexao is None and id_conexao in self.semiabertas:
+            if seq_no == self.semiabertas[id_conexao][1]:
+                del self.semiabertas[id_conexao]
+        else:
+            super()._rst_rcv(id_conexao, conexao, seq_no, ack_no)
+
+    def _syn_rcv(self, id_conexao, seq_no, agora):
+        ack_no = (seq_no + 1) & 0xffffffff
+        self.time_wait.pop(id_conexao, None)   # a outra ponta está reutilizando a quádrupla
+
+        semiaberta = self.semiabertas.get(id_conexao)
+        if semiaberta is not None and semiaberta[1] == ack_no:
+            # SYN retransmitido: reenvia o mesmo SYN+ACK sem alocar nada novo
+            self._enviar_controle(id_conexao, semiaberta[0], ack_no, FLAGS_SYN | FLAGS_ACK)
+            return
+
+        if len(self.conexoes) + len(self.semiabertas) >= self.max_conexoes:
+            self._enviar_controle(id_conexao, 0, ack_no, FLAGS_RST | FLAGS_ACK)
+            return
+
+        seq_servidor = self._cookie(id_conexao, seq_no, int(agora) >> 6)
+        if semiaberta is not None or len(self.semiabertas) < self.max_semiabertas:
+            self.semiabertas[id_conexao] = (seq_servidor, ack_no, agora)
+        # Caso contrário a fila de semiabertas está cheia e não guardamos estado:
+        # o próprio número de sequência inicial (SYN cookie) permitirá
+        # reconhecer o ACK que completa o handshake.
+        self._enviar_controle(id_conexao, seq_servidor, ack_no, FLAGS_SYN | FLAGS_ACK)
+
+    def _completar_handshake(self, id_conexao, seq_no, ack_no, agora):
+        """
+        Promove uma conexão semiaberta (ou validada por SYN cookie) a estabelecida
+        """
+        seq_servidor = (ack_no - 1) & 0xffffffff
+        semiaberta = self.semiabertas.pop(id_conexao, None)
+        if semiaberta is not None:
+            if semiaberta[0] != seq_servidor:
+                return False
+        elif not self._validar_cookie(id_conexao, (seq_no - 1) & 0xffffffff, seq_servidor, agora):
+            return False
+
+        if len(self.conexoes) >= self.max_conexoes:
+            self._enviar_controle(id_conexao, ack_no, seq_no, FLAGS_RST)
+            return False
+
+        conexao = self.conexoes[id_conexao] = Conexao(self, id_conexao, ack_no, seq_no)
+        conexao.ultima_atividade = agora
+        if self.callback:
+            self.callback(conexao)
+        return True
+
+    def _cookie(self, id_conexao, seq_no, contador):
+        """
+        Calcula o número de sequência inicial do servidor. Os 5 bits mais altos
+        guardam o contador de tempo (incrementado a cada 64 s) e os demais um
+        hash com chave secreta da quádrupla e do número de sequência do cliente.
+        """
+        dados = ('%s:%d:%s:%d:%d:%d' % (id_conexao + (seq_no, contador))).encode()
+        h = hashlib.blake2s(dados, key=self.segredo, digest_size=4).digest()
+        return ((contador & 0x1f) << 27) | (int.from_bytes(h, 'big') & 0x7ffffff)
+
+    def _validar_cookie(self, id_conexao, seq_no, cookie, agora):
+        contador = int(agora) >> 6
+        for c in (contador, contador - 1):
+            if (c & 0x1f) == (cookie >> 27) and self._cookie(id_conexao, seq_no, c) == cookie:
+                return True
+        return False
+
+    def _coletar(self, agora):
+        super()._coletar(agora)
+        while self.semiabertas:
+            id_conexao, (_, _, instante) = next(iter(self.semiabertas.items()))
+            if instante + self.tempo_semiaberta > agora:
+                break
+            del self.semiabertas[id_conexao]
+
+        while self.conexoes:
+            conexao = next(iter(self.conexoes.values()))
+            if conexao.ultima_atividade + self.tempo_ocioso > agora:
+                break
+            self._despejar(conexao)
+
+    def _despejar(self, conexao):
+        self._enviar_controle(conexao.id_conexao, conexao.seq_envio, conexao.ack_no, FLAGS_RST | FLAGS_ACK)
+        self._abortar(conexao)
+
+    def _pendente(self):
+        # As conexões estabelecidas também expiram, por ociosidade
+        return bool(self.conexoes or self.semiabertas or self.time_wait)
+
+
+class Cliente(Extremidade):
+    def __init__(self, rede, lote=False):
+        """
+        Abre conexões a partir desta ponta (abertura ativa). Pode compartilhar
+        a camada de rede com servidores: cada porta local que o Cliente usa é
+        registrada no mesmo Demultiplexador que eles. O argumento lote tem o
+        mesmo significado que no Servidor.
+        """
+        super().__init__(rede)
+        self.demultiplexador = _demultiplexador(rede)
+        self.abrindo = {}                # id_conexao -> [seq inicial, future, timer, SYNs enviados]
+        self.portas = set()              # portas locais em uso
+        self.proxima_porta = random.randint(*PORTAS_EFEMERAS)
+        self.tempo_syn = TEMPO_SYN
+        self.tentativas_syn = TENTATIVAS_SYN
+        self.retransmissoes_syn = 0
+        self.recebe_lote = lote
+
+    async def conectar(self, dst_addr, dst_port):
+        """
+        Abre uma conexão com dst_addr:dst_port e devolve a Conexao quando o
+        handshake terminar. Lança ConnectionRefusedError se a outra ponta
+        recusar a conexão e TimeoutError se nenhum SYN+ACK chegar.
+        """
+        self._coletar(monotonic())
+        porta = self._alocar_porta()
+        id_conexao = (dst_addr, dst_port, self.rede.endereco_host, porta)
+        futuro = asyncio.get_event_loop().create_future()
+        self.abrindo[id_conexao] = [int.from_bytes(os.urandom(4), 'big'), futuro, None, 0]
+        try:
+            self._enviar_syn(id_conexao)
+            return await futuro
+        finally:
+            # Se o handshake não completou, libera o que foi reservado
+            abertura = self.abrindo.pop(id_conexao, None)
+            if abertura is not None:
+                if abertura[2] is not None:
+                    abertura[2].cancel()
+                self._liberar_porta(porta)
+
+    def _alocar_porta(self):
+        primeira, ultima = PORTAS_EFEMERAS
+        for _ in range(ultima - primeira + 1):
+            porta = self.proxima_porta
+            self.proxima_porta = primeira if porta == ultima else porta + 1
+            if porta not in self.portas and porta not in self.demultiplexador.donos:
+                self.portas.add(porta)
+                self.demultiplexador.registrar(porta, self, self.recebe_lote)
+                return porta
+        raise OSError('não há portas efêmeras livres')
+
+    def _liberar_porta(self, porta):
+        self.portas.discard(porta)
+        self.demultiplexador.remover(porta, self)
+
+    def _enviar_syn(self, id_conexao):
+        abertura = self.abrindo[id_conexao]
+        seq_inicial, futuro, _, enviados = abertura
+        if futuro.done():
+            return
+        if enviados == self.tentativas_syn:
+            futuro.set_exception(TimeoutError('%s:%d não respondeu' % id_conexao[:2]))
+            return
+        if enviados:
+            self.retransmissoes_syn += 1
+        try:
+            self._enviar_controle(id_conexao, seq_inicial, 0, FLAGS_SYN)
+        except Exception as e:
+            # Por exemplo, sem rota para o destino. Quando chamado pelo timer,
+            # só o future pode levar o erro até quem espera a conexão.
+            futuro.set_exception(e)
+            return
+        abertura[2] = asyncio.get_event_loop().call_later(self.tempo_syn * 2**enviados,
+                                                          self._enviar_syn, id_conexao)
+        abertura[3] = enviados + 1
+
+    def _rdt_rcv(self, src_addr, dst_addr, segment):
+        src_port, dst_port, seq_no, ack_no, flags = struct.unpack_from('!HHIIH', segment)
+        id_conexao = (src_addr, src_port, dst_addr, dst_port)
+        conexao = self.conexoes.get(id_conexao)
+        if conexao is None and id_conexao not in self.abrindo and id_conexao not in self.time_wait:
+            return   # sobra de uma conexão que já esquecemos
+        if not self.rede.ignore_checksum and not checksum_valido(segment, src_addr, dst_addr):
+            print('descartando segmento com checksum incorreto')
+            return
+
+        if (flags & FLAGS_RST) == FLAGS_RST:
+            self._rst_rcv(id_conexao, conexao, seq_no, ack_no)
+        elif conexao is not None:
+            if (flags & FLAGS_SYN) == FLAGS_SYN:
+                # SYN+ACK retransmitido: o nosso ACK do handshake se perdeu
+                conexao._enviar_ack()
+            else:
+                conexao._rdt_rcv(seq_no, ack_no, flags, segment[4*(flags>>12):])
+        elif id_conexao in self.abrindo:
+            if (flags & (FLAGS_SYN | FLAGS_ACK)) == (FLAGS_SYN | FLAGS_ACK):
+                self._synack_rcv(id_conexao, seq_no, ack_no)
+        else:
+            self._time_wait_rcv(id_conexao, flags)
+
+        self._agendar_coleta()
+
+    def _synack_rcv(self, id_conexao, seq_no, ack_no):
+        seq_inicial, futuro, timer, _ = self.abrindo[id_conexao]
+        if ack_no != (seq_inicial + 1) & 0xffffffff or futuro.done():
+            # Não confirma o SYN que estamos esperando (ou desistimos dele)
+            self._enviar_controle(id_conexao, ack_no, 0, FLAGS_RST)
+            return
+        del self.abrindo[id_conexao]
+        timer.cancel()
+        conexao = self.conexoes[id_conexao] = Conexao(self, id_conexao, ack_no, (seq_no + 1) & 0xffffffff)
+        conexao._enviar_ack()
+        futuro.set_result(conexao)
+
+    def _rst_rcv(self, id_conexao, conexao, seq_no, ack_no):
+        if conexao is None and id_conexao in self.abrindo:
+            seq_inicial, futuro, _, _ = self.abrindo[id_conexao]
+            if ack_no == (seq_inicial + 1) & 0xffffffff and not futuro.done():
+                futuro.set_exception(ConnectionRefusedError('%s:%d recusou a conexão' % id_conexao[:2]))
+        else:
+            super()._rst_rcv(id_conexao, conexao, seq_no, ack_no)
+
+    def _esquecer_time_wait(self, id_conexao):
+        # A porta local só é liberada quando o TIME_WAIT termina
+        super()._esquecer_time_wait(id_conexao)
+        self._liberar_porta(id_conexao[3])
+
+    def _remover(self, conexao):
+        super()._remover(conexao)
+        if conexao.id_conexao not in self.time_wait:
+            self._liberar_porta(conexao.id_conexao[3])
+
+
+async def connect(rede, dst_addr, dst_port):
+    """
+    Abre uma conexão TCP com dst_addr:dst_port (abertura ativa) e devolve a
+    Conexao estabelecida. Todas as conexões abertas sobre a mesma camada de
+    rede compartilham um único Cliente, criado na primeira chamada.
+    """
+    demultiplexador = _demultiplexador(rede)
+    if demultiplexador.cliente is None:
+        demultiplexador.cliente = Cliente(rede)
+    cliente = demultiplexador.cliente
+    return await cliente.conectar(dst_addr, dst_port)
+
 
 class Conexao:
+    # Uma conexão ociosa deve custar o mínimo possível: sem __dict__, sem
+    # buffers alocados e sem timer agendado enquanto não houver dados em voo.
+    __slots__ = ('servidor', 'id_conexao', 'callback', 'estado',
+                 'seq_no', 'seq_envio', 'ack_no', 'buffer',
+                 'cwnd', 'rcv_cwnd', 'seq_medido', 'EstimatedRTT', 'DevRTT',
+                 'TimeoutInterval', 'SentTime', 'timer', 'ultima_atividade',
+                 'produtor', 'espera', 'ack_adiado', 'ack_pendente', 'retransmissoes')
+
     def __init__(self, servidor, id_conexao, seq_no, ack_no):
-        self.servidor = servidor
+        self.servidor = servidor  # o Servidor ou Cliente dono da conexão
         self.id_conexao = id_conexao
         self.callback = None
-        self.seq_no = seq_no
-        self.ack_no = ack_no
-        self.ack_client = ack_no
-        self.seq_client = ack_no
-        self.sent_data = {}
-        self.segments = {}
-        self.SampleRTT = 0
-        self.DevRTT = 0
-        self.EstimatedRTT = 0
-        self.TimeoutInterval = 1
-        self.SentTime = 0
+        self.estado = ESTABELECIDA
+        self.seq_no = seq_no      # primeiro byte ainda não confirmado pela outra ponta
+        self.seq_envio = seq_no   # próximo byte a ser transmitido
+        self.ack_no = ack_no      # próximo byte esperado da outra ponta
+        self.buffer = None        # bytearray com os dados não confirmados, criado sob demanda
         self.cwnd = MSS
         self.rcv_cwnd = 0
-        self.reenvio = False
-        self.open = True
-        self.timer = None  # um timer pode ser criado assim; esta linha é só um exemplo e pode ser removida
-        #self.timer.cancel()   # é possível cancelar o timer chamando esse método; esta linha é só um exemplo e pode ser removida
+        self.seq_medido = None    # fim do segmento cujo RTT está sendo medido
+        self.EstimatedRTT = 0
+        self.DevRTT = 0
+        self.TimeoutInterval = 1
+        self.SentTime = 0         # instante em que esse segmento foi transmitido
+        self.timer = None
+        self.ultima_atividade = monotonic()
+        self.produtor = None      # tarefa de um envio em fluxo (enviar_stream) em andamento
+        self.espera = None        # future que o produtor aguarda até haver espaço no buffer
+        self.ack_adiado = None    # maior ACK puro recebido no lote atual, ainda não processado
+        self.ack_pendente = False # recebemos dados no lote atual e ainda não os confirmamos
+        self.retransmissoes = 0
 
-    def _exemplo_timer(self):
-        # Esta função é só um exemplo e pode ser removida
-        self.reenvio = True
-        self.cwnd = ((self.cwnd/MSS)//2)*MSS
-        self.enviar(self.sent_data[list(self.sent_data.keys())[0]])
+    def _timeout(self):
+        self.timer = None
+        # Algoritmo de Karn: não mede o RTT de um segmento retransmitido, e o
+        # temporizador fica dobrado até que uma nova medida seja feita
+        self.seq_medido = None
+        self.TimeoutInterval = min(2*self.TimeoutInterval, RTO_MAXIMO)
+        self.retransmissoes += 1
+        self.cwnd = max(MSS, (self.cwnd // MSS // 2) * MSS)
+        self.rcv_cwnd = 0
+        # Retransmite apenas o primeiro segmento não confirmado
+        n = len(self.buffer) if self.buffer else 0
+        if n:
+            self._enviar_segmento(self.seq_no, self.buffer[:MSS], FLAGS_ACK)
+        else:
+            self._enviar_segmento(self.seq_no, b'', FLAGS_FIN | FLAGS_ACK)
+        self._armar_timer()
 
-        # print('Este é um exemplo de como fazer um timer')
+    def _armar_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = asyncio.get_event_loop().call_later(self.TimeoutInterval, self._timeout)
 
     def _rdt_rcv(self, seq_no, ack_no, flags, payload):
-        # TODO: trate aqui o recebimento de segmentos provenientes da camada de rede.
-        # Chame self.callback(self, dados) para passar dados para a camada de aplicação após
-        # garantir que eles não sejam duplicados e que tenham sido recebidos em
-        # ordem.
-        # print('recebido payload: %r' % payload)
-        if len(self.sent_data):
-            if not self.reenvio:
-                first = 0 == self.SampleRTT
-                self.SampleRTT = time() - self.SentTime
-                if first:
-                    self.EstimatedRTT = self.SampleRTT
-                    self.DevRTT = self.SampleRTT/2
-                else:
-                    self.EstimatedRTT = (0.875)*self.EstimatedRTT + 0.125*self.SampleRTT
-                    self.DevRTT = (0.75)*self.DevRTT + 0.25* abs(self.SampleRTT - self.EstimatedRTT)
-                self.TimeoutInterval = self.EstimatedRTT + 4*self.DevRTT
-                
-            if ack_no > list(self.sent_data.keys())[0]:
-                y = list(self.sent_data.keys())[0]
-                while y < ack_no:
-                    self.rcv_cwnd += len(self.segments[y]) 
-                    del self.segments[y]
-                    del self.sent_data[y]
-                    if 0 == len(self.sent_data):
-                        break
-                    y = list(self.sent_data.keys())[0]
-                    
-                if len(self.sent_data):
-                    if(self.timer is not None):
-                        self.timer.cancel()
-                    self.timer = asyncio.get_event_loop().call_later(self.TimeoutInterval, self._exemplo_timer)
-                else:
-                    self.timer.cancel()
-                if self.rcv_cwnd >= self.cwnd or 0 == len(self.sent_data):
-                    self.cwnd += MSS
-                    self.rcv_cwnd = 0
-                    if len(self.sent_data):
-                        if(self.timer is not None):
-                            self.timer.cancel()
-                        self.timer = asyncio.get_event_loop().call_later(self.TimeoutInterval, self._exemplo_timer)
-                        self.enviar(self.sent_data[list(self.sent_data.keys())[0]])
-
-        self.reenvio = False or not True #ser ou não ser
-
-        if seq_no != self.ack_no or (not len(payload) and (flags & FLAGS_FIN) != FLAGS_FIN) or not self.open: return
-        # print('ENTREI AQUI EM ALGUM MOMENTO, ack_no, seq_no, pay', ack_no, seq_no, len(payload))
-        src_addr, src_port, dst_addr, dst_port = self.id_conexao
-        self.seq_no = self.ack_no
-        self.ack_no += len(payload) 
-        if (flags & FLAGS_FIN) == FLAGS_FIN:
-            self.ack_no += 1
-        self.ack_client = self.ack_no
-        # print('SAI DAQUI EM ALGUM MOMENTO, ack_no, seq_no', self.ack_no, self.seq_no)
-        self.callback(self, payload) 
-        flags = FLAGS_ACK
-        newSegment = fix_checksum(make_header(dst_port, src_port, self.seq_no, self.ack_no, flags), src_addr, dst_addr)
-        self.servidor.rede.enviar(newSegment,src_addr)
-        if (flags & FLAGS_FIN) == FLAGS_FIN:
-            self.fechar()
+        lote = self.servidor.lote
+        fin = (flags & FLAGS_FIN) == FLAGS_FIN
+        if (flags & FLAGS_ACK) == FLAGS_ACK:
+            if lote is not None and not len(payload) and not fin:
+                # ACK puro dentro de um lote: basta processar o maior deles no fim
+                if self.ack_adiado is None or seq_menor(self.ack_adiado, ack_no):
+                    self.ack_adiado = ack_no
+                lote[self] = None
+                return
+            if self.ack_adiado is not None:
+                self._ack_rcv(self.ack_adiado)
+                self.ack_adiado = None
+            self._ack_rcv(ack_no)
+            if self.estado == FECHADA:
+                return
+
+        if not len(payload) and not fin: return
+        if seq_no != self.ack_no or self.estado not in (ESTABELECIDA, FIN_WAIT, FIN_WAIT_2):
+            # Duplicado ou fora de ordem: reafirma o que já recebemos, pois a
+            # retransmissão pode ser sinal de que o nosso ACK se perdeu
+            if lote is not None:
+                self.ack_pendente = True
+                lote[self] = None
+            else:
+                self._enviar_ack()
             return
+        self.ack_no = (self.ack_no + len(payload)) & 0xffffffff
+        if fin:
+            self.ack_no = (self.ack_no + 1) & 0xffffffff
+        if lote is not None and not fin:
+            self.ack_pendente = True
+            lote[self] = None
+        else:
+            self._enviar_ack()
+        if fin:
+            if self.estado in (FIN_WAIT, FIN_WAIT_2):
+                # Fechamento ativo: fomos os primeiros a enviar FIN
+                self.servidor._entrar_time_wait(self)
+            else:
+                self.estado = CLOSE_WAIT
+        if self.callback:
+            # O FIN pode vir no mesmo segmento que os últimos dados: a
+            # aplicação recebe os dados e, em seguida, o aviso de fim (b'')
+            if len(payload):
+                self.callback(self, bytes(payload))
+            if fin:
+                self.callback(self, b'')
+
+    def _ack_rcv(self, ack_no):
+        confirmados = (ack_no - self.seq_no) & 0xffffffff
+        if confirmados == 0 or confirmados > ((self.seq_envio - self.seq_no) & 0xffffffff):
+            return   # ACK duplicado ou de algo que nunca enviamos
+
+        if self.seq_medido is not None and not seq_menor(ack_no, self.seq_medido):
+            SampleRTT = monotonic() - self.SentTime
+            self.seq_medido = None
+            if self.EstimatedRTT == 0:
+                self.EstimatedRTT = SampleRTT
+                self.DevRTT = SampleRTT/2
+            else:
+                self.EstimatedRTT = 0.875*self.EstimatedRTT + 0.125*SampleRTT
+                self.DevRTT = 0.75*self.DevRTT + 0.25*abs(SampleRTT - self.EstimatedRTT)
+            self.TimeoutInterval = min(max(self.EstimatedRTT + 4*self.DevRTT, RTO_MINIMO), RTO_MAXIMO)
+
+        n = len(self.buffer) if self.buffer else 0
+        fin_confirmado = confirmados > n
+        if n:
+            del self.buffer[:confirmados]
+            if not self.buffer:
+                self.buffer = None
+        self.seq_no = ack_no
+
+        self.rcv_cwnd += confirmados
+        if self.rcv_cwnd >= self.cwnd:
+            self.cwnd += MSS
+            self.rcv_cwnd = 0
+
+        if self.seq_envio == self.seq_no:
+            # Nada mais em voo
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if fin_confirmado:
+                if self.estado == LAST_ACK:
+                    # Nosso FIN foi confirmado depois de já termos recebido o FIN da outra ponta
+                    self.servidor._remover(self)
+                    return
+                self.estado = FIN_WAIT_2
+        else:
+            self._armar_timer()
+        self._transmitir()
+        self._acordar_produtor()
+
+    def _fin_enviado(self):
+        n = len(self.buffer) if self.buffer else 0
+        return self.estado in (FIN_WAIT, LAST_ACK) and \
+            ((self.seq_envio - self.seq_no) & 0xffffffff) > n
+
+    def _transmitir(self):
+        """
+        Transmite o que couber na janela de congestionamento, montando cada
+        segmento a partir do buffer só no momento do envio.
+        """
+        n = len(self.buffer) if self.buffer else 0
+        em_voo = (self.seq_envio - self.seq_no) & 0xffffffff
+        enviou = False
+        while em_voo < n and em_voo < self.cwnd:
+            payload = self.buffer[em_voo:em_voo+MSS]
+            self._enviar_segmento(self.seq_envio, payload, FLAGS_ACK)
+            self.seq_envio = (self.seq_envio + len(payload)) & 0xffffffff
+            self._medir_rtt()
+            em_voo += len(payload)
+            enviou = True
+        if em_voo == n and self.estado in (FIN_WAIT, LAST_ACK) and self.produtor is None \
+                and not self._fin_enviado():
+            # Todos os dados já saíram: o FIN ocupa o número de sequência seguinte
+            self._enviar_segmento(self.seq_envio, b'', FLAGS_FIN | FLAGS_ACK)
+            self.seq_envio = (self.seq_envio + 1) & 0xffffffff
+            self._medir_rtt()
+            enviou = True
+        if enviou and self.timer is None:
+            self._armar_timer()
+
+    def _medir_rtt(self):
+        # Chamado logo após transmitir um segmento pela primeira vez. Só um
+        # segmento é medido de cada vez; o RTT é o tempo até o ACK que o cobre.
+        if self.seq_medido is None:
+            self.seq_medido = self.seq_envio
+            self.SentTime = monotonic()
+
+    def _fim_lote(self):
+        if self.ack_adiado is not None:
+            ack_no, self.ack_adiado = self.ack_adiado, None
+            if self.estado != FECHADA:
+                self._ack_rcv(ack_no)
+        if self.ack_pendente and self.estado != FECHADA:
+            self._enviar_ack()
+
+    def _enviar_segmento(self, seq_no, payload, flags):
+        # Todo segmento leva o nosso ack_no, então não há mais ACK pendente
+        self.ack_pendente = False
+        src_addr, src_port, dst_addr, dst_port = self.id_conexao
+        segmento = montar_segmento(dst_port, src_port, seq_no, self.ack_no, flags, payload,
+                                   src_addr, dst_addr)
+        self.servidor.rede.enviar(segmento, src_addr)
+
+    def _enviar_ack(self):
+        self._enviar_segmento(self.seq_envio, b'', FLAGS_ACK)
+
+    def _encerrar(self):
+        self.estado = FECHADA
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self._acordar_produtor(ConnectionResetError('conexão encerrada'))
+
+    def _acordar_produtor(self, erro=None):
+        espera, self.espera = self.espera, None
+        if espera is not None and not espera.done():
+            if erro is None:
+                espera.set_result(None)
+            else:
+                espera.set_exception(erro)
+
+    async def _aguardar_ack(self):
+        # Depois que a conexão é removida ninguém mais resolveria a espera
+        if self.estado == FECHADA:
+            raise ConnectionResetError('conexão encerrada')
+        self.espera = asyncio.get_event_loop().create_future()
+        await self.espera
+
+    async def _produzir(self, blocos):
+        """
+        Copia os blocos para o buffer de envio sem deixar que ele acumule mais
+        do que BLOCO bytes ainda não transmitidos além do que está em voo.
+        """
+        total = 0
+        try:
+            async for bloco in blocos:
+                while self.buffer and len(self.buffer) - \
+                        ((self.seq_envio - self.seq_no) & 0xffffffff) >= BLOCO:
+                    await self._aguardar_ack()
+                # A conexão pode ter sido removida enquanto o iterador produzia o bloco
+                if self.estado == FECHADA:
+                    raise ConnectionResetError('conexão encerrada')
+                if self.buffer is None:
+                    self.buffer = bytearray(bloco)
+                else:
+                    self.buffer += bloco
+                total += len(bloco)
+                self._transmitir()
+        finally:
+            self.produtor = None
+            if hasattr(blocos, 'aclose'):
+                await blocos.aclose()
+        if self.estado == FECHADA:
+            raise ConnectionResetError('conexão encerrada')
+        # Libera o FIN, caso fechar() tenha sido chamado durante o envio
+        self._transmitir()
+        while self.buffer is not None:
+            await self._aguardar_ack()
+        return total
 
 
     # Os métodos abaixo fazem parte da API
@@ -161,72 +832,68 @@ class Conexao:
         """
         Usado pela camada de aplicação para enviar dados
         """
-        if not self.open: return
-        src_addr, src_port, dst_addr, dst_port = self.id_conexao
-        # TODO: implemente aqui o envio de dados.
-        # Chame self.servidor.rede.enviar(segmento, dest_addr) para enviar o
-        # segmento
-        # if len(self.sent_data):
-        #     for key,value in self.sent_data.items():
-        #         if(value == dados):
-        #             self.seq_client = key
-
-        i = 0
-        src_addr, src_port, dst_addr, dst_port = self.id_conexao
-        # seq_no = 
-
-        if 0 == len(self.sent_data):
-            while i < len(dados):
-                payload = dados[i:i+MSS]
-                flags = FLAGS_ACK
-                # self._rdt_rcv(self.seq_no, self.ack_no, flags, payload)
-                # seq_no = self.ack_client
-                # print(f'APOS ITERACAO, ack = {self.ack_no}, seq = {self.seq_client}')
-                self.sent_data[self.seq_client] = payload 
-                newSegment = fix_checksum(make_header(dst_port, src_port, self.seq_client, self.ack_no, flags) + payload, src_addr, dst_addr)
-                # self.servidor.rede.enviar(newSegment,src_addr)
-                self.segments[self.seq_client] = newSegment
-                self.seq_client += len(payload)
-                # seq_no = self.ack_client
-                # print(f'pld = {len(payload)} sq = {self.seq_no}')
-                i += MSS
-        cont = 0
-        # print(self.sent_data.keys(), 'HEREEEEEEEEEEEEEEEE')
-        if not self.reenvio:
-            for j in self.sent_data.keys():
-                # self.seq_client = j
-                if(cont >= self.cwnd):
-                    break
-                self.servidor.rede.enviar(self.segments[j],src_addr)
-                cont += len(self.segments[j])
+        if self.estado not in (ESTABELECIDA, CLOSE_WAIT) or not dados: return
+        if self.buffer is None:
+            self.buffer = bytearray(dados)
         else:
-            y = list(self.sent_data.keys())[0]
-            self.servidor.rede.enviar(self.segments[y],src_addr)
-        
-        self.SentTime = time()
-        if(self.timer is not None):
-            self.timer.cancel()
-        self.timer = asyncio.get_event_loop().call_later(self.TimeoutInterval, self._exemplo_timer)
-            
-                
+            self.buffer += dados
+        self._transmitir()
 
-           
-        
-        # self.ack_no += len(dados)
-        # self.ack_no = self.seq_no
-        # que você construir para a camada de rede.
+    def enviar_arquivo(self, arquivo):
+        """
+        Usado pela camada de aplicação para enviar o conteúdo de um arquivo sem
+        carregá-lo inteiro na memória. O argumento pode ser um objeto arquivo
+        aberto em modo binário ou um caminho, que será mapeado com mmap.
+        Retorna o mesmo future que enviar_stream.
+        """
+        return self.enviar_stream(_ler_arquivo(arquivo))
 
+    def enviar_stream(self, blocos):
+        """
+        Usado pela camada de aplicação para enviar os blocos de bytes produzidos
+        por um iterador assíncrono. Os segmentos só são montados à medida que a
+        janela de congestionamento abre, e apenas os dados em voo ficam na
+        memória. Retorna um future que é resolvido com o total de bytes
+        enviados quando a outra ponta tiver confirmado todos eles.
+        """
+        loop = asyncio.get_event_loop()
+        if self.estado not in (ESTABELECIDA, CLOSE_WAIT) or self.produtor is not None:
+            futuro = loop.create_future()
+            futuro.set_exception(ConnectionError('conexão fechada ou com outro envio em andamento'))
+            return futuro
+        self.produtor = loop.create_task(self._produzir(blocos))
+        return self.produtor
 
     def fechar(self):
         """
         Usado pela camada de aplicação para fechar a conexão
         """
-        print('got here as well')
-        src_addr, src_port, dst_addr, dst_port = self.id_conexao
-        # TODO: implemente aqui o fechamento de conexão
-        self.callback(self,b'')
-        flags = FLAGS_FIN
-        newSegment = fix_checksum(make_header(dst_port, src_port, self.seq_no, self.ack_no, flags) , src_addr, dst_addr)
-        self.servidor.rede.enviar(newSegment,src_addr)
-        self.open = False
-        pass
+        if self.estado not in (ESTABELECIDA, CLOSE_WAIT): return
+        self.estado = LAST_ACK if self.estado == CLOSE_WAIT else FIN_WAIT
+        # O FIN sai assim que todos os dados enfileirados tiverem sido transmitidos
+        self._transmitir()
+
+
+async def _ler_arquivo(arquivo):
+    """
+    Gera o conteúdo de um arquivo em blocos de BLOCO bytes. Caminhos são
+    mapeados com mmap, e as páginas já lidas são devolvidas ao sistema
+    operacional para não inflarem a memória residente do processo.
+    """
+    if not isinstance(arquivo, (str, bytes, os.PathLike)):
+        while True:
+            bloco = arquivo.read(BLOCO)
+            if not bloco:
+                return
+            yield bloco
+
+    with open(arquivo, 'rb') as f:
+        tamanho = os.fstat(f.fileno()).st_size
+        if tamanho == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for inicio in range(0, tamanho, BLOCO):
+                with memoryview(mm)[inicio:inicio+BLOCO] as bloco:
+                    yield bloco
+                if hasattr(mm, 'madvise'):
+                    mm.madvise(mmap.MADV_DONTNEED, inicio, min(BLOCO, tamanho - inicio))